@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+#
+"""
+Benchmark check_links_3.py against a generated Jekyll-style site.
+
+The site's external links point at local stub servers which respond with
+the status code and after the delay encoded in each URL, so that the
+external checks can be measured without going anywhere near the internet.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+import check_links_3
+
+# The widths that the generated srcset images are produced at.
+IMAGE_WIDTHS = (576, 768, 992, 1200, 1920)
+
+
+def free_ports(count):
+    """ Return the requested number of currently unused local ports. """
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def run_stub_servers(ports):
+    """
+    Serve /<status>/<delay in ms>/<name> on each of the ports, responding
+    with that status after that delay. Each port is a separate "host" as
+    far as the link checker is concerned.
+    """
+    async def handler(request):
+        delay = int(request.match_info["delay"])
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        return web.Response(status=int(request.match_info["status"]))
+
+    async def serve():
+        app = web.Application()
+        app.router.add_route("*", "/{status}/{delay}/{name}", handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        for port in ports:
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(serve())
+
+
+def wait_for_ports(ports, timeout=10):
+    """ Wait until something is listening on all of the ports. """
+    deadline = time.time() + timeout
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.5).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    print("Stub server didn't start on port %s" % port)
+                    sys.exit(1)
+                time.sleep(0.05)
+
+
+def external_urls(options, ports, rng):
+    """
+    Build the pool of external URLs that the pages link to. The hosts are
+    Zipf-distributed so that a few of them get most of the links, as
+    happens with GitHub on the real sites.
+    """
+    weights = [1 / (rank + 1) ** options.host_skew for rank in range(len(ports))]
+    urls = []
+    for number in range(options.external_urls):
+        port = rng.choices(ports, weights)[0]
+        status = 404 if rng.random() < options.broken_ratio else 200
+        delay = max(0, int(rng.gauss(options.latency, options.latency_jitter)))
+        urls.append("http://127.0.0.1:%s/%s/%s/link%s" % (port, status, delay, number))
+    return urls
+
+
+def picture(image, rng):
+    """ Return a <picture> block for the image like jekyll_picture_tag does. """
+    digest = "%06x" % rng.randrange(16**6)
+    srcset = ", ".join(
+        "/../generated/assets/images/content/%s-%s-%s.webp %sw" % (
+            image, width, digest, width)
+        for width in IMAGE_WIDTHS)
+    return (
+        '<picture><source type="image/webp" data-srcset="%s">'
+        '<img src="/assets/images/content/%s.jpg" alt=""></picture>' % (srcset, image),
+        ["generated/assets/images/content/%s-%s-%s.webp" % (image, width, digest)
+         for width in IMAGE_WIDTHS])
+
+
+def write_file(root, path, content):
+    """ Write the file, creating its directory if needed. """
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "w") as myfile:
+        myfile.write(content)
+
+
+def generate_site(root, options, ports):
+    """ Generate the synthetic site under root. """
+    rng = random.Random(options.seed)
+    pages = [
+        "section%s/page%s" % (number % options.sections, number)
+        for number in range(options.pages)
+    ]
+    urls = external_urls(options, ports, rng)
+    images = ["image%s" % number for number in range(options.images)]
+    generated = set()
+    for image in images:
+        write_file(root, "assets/images/content/%s.jpg" % image, "jpg")
+    write_file(root, "assets/css/main.css", "body {}")
+    write_file(root, "assets/js/main.js", "")
+    # A few files that nothing refers to.
+    for number in range(max(1, options.pages // 100)):
+        write_file(root, "assets/unused/file%s.pdf" % number, "pdf")
+    nav = "".join(
+        '<a href="/section%s/">Section %s</a>' % (number, number)
+        for number in range(options.sections))
+    for number in range(options.sections):
+        write_file(root, "section%s/index.html" % number,
+                   "<html><body>%s</body></html>" % nav)
+    for page in pages:
+        body = [nav]
+        for _ in range(options.links_per_page):
+            if rng.random() < options.broken_ratio:
+                body.append('<a href="/%s/missing%s/">x</a>' % (
+                    rng.choice(pages), rng.randrange(1000)))
+            else:
+                body.append('<a href="/%s/">x</a>' % rng.choice(pages))
+        for _ in range(options.pictures_per_page):
+            block, variants = picture(rng.choice(images), rng)
+            body.append(block)
+            generated.update(variants)
+        if urls:
+            for _ in range(options.external_per_page):
+                body.append('<a href="%s">x</a>' % rng.choice(urls))
+        write_file(root, page + "/index.html", (
+            '<html><head><link rel="stylesheet" href="/assets/css/main.css">'
+            '<script src="/assets/js/main.js"></script></head>'
+            '<body>%s</body></html>' % "\n".join(body)))
+    for variant in generated:
+        write_file(root, variant, "webp")
+
+
+class PhaseTimer:
+    """ Collect the timings for each phase of the link check. """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name, pages):
+        """
+        Time the code run in the context. The caller sets "links" (and
+        "pages" if it isn't known up front) in the yielded dictionary to
+        the number of links and pages the phase dealt with.
+        """
+        counts = {"pages": pages, "links": 0}
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        # Keep the link checker's progress output out of the way.
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield counts
+        self.phases.append({
+            "phase": name,
+            "seconds": time.perf_counter() - start,
+            "cpu_seconds": time.process_time() - cpu_start,
+            "pages": counts["pages"],
+            "links": counts["links"],
+            # ru_maxrss is in KB on Linux. It is the high-water mark for the
+            # whole process so far, not just this phase.
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        })
+
+    def report(self):
+        """ Print a table of the phases. """
+        print("%-10s %9s %9s %10s %12s %10s" % (
+            "phase", "seconds", "cpu", "pages/s", "links/s", "peak MB"))
+        for phase in self.phases:
+            seconds = max(phase["seconds"], 1e-9)
+            print("%-10s %9.3f %9.3f %10.1f %12.1f %10.1f" % (
+                phase["phase"], phase["seconds"], phase["cpu_seconds"],
+                phase["pages"] / seconds, phase["links"] / seconds,
+                phase["peak_rss_mb"]))
+        print("%-10s %9.3f" % (
+            "total", sum(phase["seconds"] for phase in self.phases)))
+
+
+def run_checker(site, options):
+    """ Run each phase of the link checker over the site, timing them. """
+    checker_args = [
+        "--parser", options.parser,
+        "--max-connections", str(options.max_connections),
+        "--per-host-limit", str(options.per_host_limit)
+    ]
+    if options.noexternal:
+        checker_args.append("--noexternal")
+    check_links_3.args = check_links_3.build_arg_parser().parse_args(checker_args)
+    os.chdir(site)
+    timer = PhaseTimer()
+
+    with timer.phase("walk", 0) as counts:
+        html_files = check_links_3.get_all_html_files("./")
+        counts["pages"] = len(html_files)
+    pages = len(html_files)
+
+    parsed = []
+    with timer.phase("parse", pages) as counts:
+        for filename in html_files:
+            with open(filename, "r") as myfile:
+                tags = check_links_3.group_tags(
+                    check_links_3.EXTRACTORS[options.parser](myfile))
+            parsed.append((filename, tags))
+            counts["links"] += sum(len(attrs) for attrs in tags.values())
+
+    with timer.phase("internal", pages) as counts:
+        for filename, tags in parsed:
+            scan = check_links_3.new_file_scan(filename)
+            check_links_3.validate_tags(filename, tags, scan)
+            check_links_3.merge_file_scan(scan)
+            counts["links"] += sum(len(attrs) for attrs in tags.values())
+        check_links_3.reference_scanned_files()
+    del parsed
+
+    if not options.noexternal:
+        with timer.phase("external", pages) as counts:
+            failures = check_links_3.run_async(check_links_3.check_unique_links())
+            check_links_3.SITE.failed_links.update(failures)
+            counts["links"] = len(check_links_3.UNIQUE_LINKS)
+
+    with timer.phase("report", pages) as counts:
+        output = io.StringIO()
+        check_links_3.report_failed_dirs(check_links_3.SITE.failed_dirs, output)
+        check_links_3.report_failed_links(check_links_3.SITE.failed_links, output)
+        size = 0
+        for unref in check_links_3.SITE.all_files:
+            print(unref, file=output)
+            size += os.path.getsize(unref)
+        counts["links"] = len(check_links_3.SITE.failed_links)
+
+    print("%s pages, %s unique web links, %s failed links, %s unreferenced files" % (
+        pages, len(check_links_3.UNIQUE_LINKS), len(check_links_3.SITE.failed_links),
+        len(check_links_3.SITE.all_files)))
+    timer.report()
+    return timer.phases
+
+
+def main():
+    """ Main code. """
+    parser = argparse.ArgumentParser(
+        description="Benchmark check_links_3.py on a synthetic site")
+    parser.add_argument('--pages', type=int, default=1000,
+                        help='specifies the number of pages (default: 1000)')
+    parser.add_argument('--sections', type=int, default=20,
+                        help='specifies the number of top-level sections')
+    parser.add_argument('--links-per-page', type=int, default=40,
+                        help='specifies the internal links on each page')
+    parser.add_argument('--pictures-per-page', type=int, default=4,
+                        help='specifies the srcset <picture> blocks on each page')
+    parser.add_argument('--images', type=int, default=200,
+                        help='specifies the number of distinct images')
+    parser.add_argument('--external-per-page', type=int, default=10,
+                        help='specifies the external links on each page')
+    parser.add_argument('--external-urls', type=int, default=2000,
+                        help='specifies the number of distinct external URLs')
+    parser.add_argument('--hosts', type=int, default=10,
+                        help='specifies the number of external hosts')
+    parser.add_argument('--host-skew', type=float, default=1.0,
+                        help='specifies the Zipf exponent for how links are '
+                        'spread over the hosts; 0 spreads them evenly')
+    parser.add_argument('--broken-ratio', type=float, default=0.02,
+                        help='specifies the fraction of links that are broken')
+    parser.add_argument('--latency', type=int, default=50,
+                        help='specifies the mean stub server latency in ms')
+    parser.add_argument('--latency-jitter', type=int, default=25,
+                        help='specifies the standard deviation of the latency')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='specifies the random seed for the site')
+    parser.add_argument('--parser', default='stream',
+                        choices=sorted(check_links_3.EXTRACTORS),
+                        help='specifies the link checker\'s HTML parser')
+    parser.add_argument('--max-connections', type=int, default=500)
+    parser.add_argument('--per-host-limit', type=int, default=10)
+    parser.add_argument('--noexternal', action='store_true',
+                        help='skips the external link phase')
+    parser.add_argument('--site-dir', default=None,
+                        help='specifies where to generate the site; it is '
+                        'kept afterwards (default: a temporary directory)')
+    parser.add_argument('--json', default=None,
+                        help='specifies a file to write the results to as JSON')
+    options = parser.parse_args()
+
+    ports = free_ports(options.hosts)
+    server = multiprocessing.Process(
+        target=run_stub_servers, args=(ports,), daemon=True)
+    server.start()
+    try:
+        wait_for_ports(ports)
+        with contextlib.ExitStack() as stack:
+            site = options.site_dir
+            if site is None:
+                site = stack.enter_context(tempfile.TemporaryDirectory())
+            start = time.perf_counter()
+            generate_site(site, options, ports)
+            print("Generated %s pages in %.1fs" % (
+                options.pages, time.perf_counter() - start))
+            cwd = os.getcwd()
+            phases = run_checker(site, options)
+            os.chdir(cwd)
+    finally:
+        server.terminate()
+    if options.json is not None:
+        with open(options.json, "w") as myfile:
+            json.dump({"options": vars(options), "phases": phases}, myfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+#
+""" Compare the HTML link extraction backends used by check_links_3.py. """
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import check_links_3
+
+
+def load_pages(directory, limit):
+    """
+    Read the HTML files into memory so that only the parsing is timed and
+    not the disk access.
+    """
+    pages = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.endswith((".html", ".htm")):
+                continue
+            with open(os.path.join(root, name), "r") as myfile:
+                pages.append((os.path.join(root, name), myfile.read()))
+            if limit is not None and len(pages) >= limit:
+                return pages
+    return pages
+
+
+def run_backend(extractor, pages, repeat):
+    """
+    Run the extractor over all of the pages, returning the best time out of
+    the repeated runs along with the events for each page.
+    """
+    best = None
+    events = []
+    for _ in range(repeat):
+        events = []
+        start = time.perf_counter()
+        for _, data in pages:
+            events.append(extractor(io.StringIO(data)))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, events
+
+
+def main():
+    """ Main code. """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the link checker's HTML extraction backends")
+    parser.add_argument('-d', '--directory', required=True,
+                        help='specifies the built site to read pages from')
+    parser.add_argument('-n', '--limit', type=int, default=None,
+                        help='specifies the maximum number of pages to use')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='specifies how many times to run each backend')
+    args = parser.parse_args()
+
+    pages = load_pages(args.directory, args.limit)
+    if pages == []:
+        print("No HTML files found in '%s'" % args.directory)
+        sys.exit(1)
+    size = sum(len(data) for _, data in pages) / 1024**2
+    print("%s pages, %.1fMB, best of %s runs" % (len(pages), size, args.repeat))
+
+    # BeautifulSoup is the reference that the other backends are compared
+    # against.
+    _, reference = run_backend(check_links_3.extract_tags_bs4, pages, 1)
+    print("%-8s %10s %10s %10s %10s" % (
+        "backend", "seconds", "pages/s", "MB/s", "mismatch"))
+    for name in sorted(check_links_3.EXTRACTORS):
+        if name == "lxml" and check_links_3.etree is None:
+            print("%-8s (lxml is not installed)" % name)
+            continue
+        elapsed, events = run_backend(
+            check_links_3.EXTRACTORS[name], pages, args.repeat)
+        mismatches = [
+            pages[i][0] for i in range(len(pages)) if events[i] != reference[i]
+        ]
+        print("%-8s %10.3f %10.1f %10.2f %10s" % (
+            name, elapsed, len(pages) / elapsed, size / elapsed,
+            len(mismatches)))
+        for page in mismatches[:5]:
+            print("   differs: %s" % page)
+
+
+if __name__ == '__main__':
+    main()
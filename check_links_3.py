@@ -4,20 +4,52 @@
 
 import argparse
 import asyncio
-import concurrent
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import email.utils
+import errno
+import heapq
+import gzip
+import hashlib
 import io
+import itertools
 import json
 import os
+import random
+import re
+import resource
+import select
 import socket
+import sqlite3
+import struct
 import sys
+import tempfile
+import time
 import traceback
+import xml.etree.ElementTree
+from html.parser import HTMLParser
 from os.path import join
-from urllib.parse import unquote, urlparse
+from urllib.parse import unquote, urljoin, urlparse, urlsplit, urlunsplit
 
 import aiohttp
 import requests
 from bs4 import BeautifulSoup
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # The link checking process depends on whether it is a relative
 # or absolute link. If it is a relative link, a file is looked for
 # that matches the relative path.
@@ -27,6 +59,12 @@ from bs4 import BeautifulSoup
 # scan, all of the unique links are checked in an async process and
 # the results stored. Those results are then used to update the list
 # of filename/link pairs.
+#
+# Each HTML file is checked independently of the others: everything that
+# checking a file discovers (failures, file/link pairs, referenced files) is
+# returned as a per-file result which is then merged, in file order, into the
+# globals below. That allows the files to be checked in a pool of worker
+# processes (--jobs) while producing exactly the same output as a serial run.
 
 
 CHROME = {
@@ -34,9 +72,12 @@ CHROME = {
                   'AppleWebKit/537.36 (KHTML, like Gecko) '
                   'Chrome/41.0.2228.0 Safari/537.36'
 }
+# Only ask for the first byte when falling back to a GET so that large
+# downloads don't get transferred just to find out that they exist.
+RANGED_GET = dict(CHROME, Range="bytes=0-0")
 
 # This is a list of files that should always be removed from the
-# ALL_FILES list before printing the list of unreferenced files.
+# SITE.all_files list before printing the list of unreferenced files.
 # It is, unfortunately, a bit of a hacky list since language
 # variants cause their own versions of certain files to be added
 # which means that this list must include all potential languages.
@@ -51,24 +92,322 @@ PROTECTED_FILES = [
     "./ch/feed.xml"
 ]
 
+# The tags that links are extracted from and, for each of them, the
+# attributes that are of interest. Anything else in the page is ignored.
+LINK_ATTRIBUTES = {
+    "a": ("href", "id"),
+    "img": ("src",),
+    "link": ("href",),
+    "source": ("data-srcset",),
+    "script": ("src",),
+    "form": ("action",),
+    "base": ("href",)
+}
+# When checking anchors, every id (and the name of every <a>) is recorded
+# under this pseudo-tag so that fragments can be checked against them.
+ANCHOR_TAG = "#"
+COLLECT_ANCHORS = False
+
+
+class Site:
+    """
+    What has been found out about the site being checked. With --batch, each
+    site has one of these while the web link results are shared between them.
+
+    The collections are dictionaries rather than lists so that membership
+    checks and removals don't need to scan the whole collection. Only the
+    keys matter; dictionaries preserve insertion order, which keeps the
+    reports in the order the files and links were found.
+    """
+
+    def __init__(self):
+        self.all_files = {}
+        self.referenced_files = {}
+        self.failed_dirs = {}
+        # (file, link) -> failure record, as built by failure_record
+        self.failed_links = {}
+        # file -> links found in that file
+        self.file_link_pairs = {}
+        # page -> ids that fragments in links to the page can refer to
+        self.anchors = {}
+        # file -> (page, fragment) pairs for links from the file
+        self.fragment_links = {}
+        # An index of the tree built while walking it so that internal links
+        # can be validated without going back to the filesystem. Both are
+        # keyed by the normalised path. file_index gives the path as found by
+        # the walk and dir_index gives the path of the directory's index.html
+        # (or None if it doesn't have one).
+        self.file_index = {}
+        self.dir_index = {}
+        # Symbolic links to directories aren't followed by the walk so
+        # anything below them still has to be looked up on disk.
+        self.symlinked_dirs = {}
+        # The paths in all_files sorted, so that the files starting with a
+        # prefix can be found with a binary search, along with the position
+        # of each one in the walk so that the first file found by the walk
+        # can still be picked.
+        self.sorted_files = []
+        self.walk_order = []
+        # The size of each file, taken from the directory entries as the
+        # tree is walked or, for --merge, from the files that the shards
+        # found unreferenced.
+        self.file_sizes = {}
+        # With --watch, normalised directory -> (dirs, files, below) as read
+        # by walk_tree, so that the next walk can reuse it.
+        self.listings = {}
+
+
 # Globals
-ALL_FILES = []
-FAILED_DIRS = []
-FAILED_LINKS = []
-FILE_LINK_PAIRS = []
-UNIQUE_LINKS = []
+#
+# The site being checked.
+SITE = Site()
+# Dictionaries rather than lists, as in Site.
+UNIQUE_LINKS = {}
+# With --low-memory, the file/link pairs and the failed links are kept in
+# this SQLite database on disk instead of in the Site,
+# so that memory use doesn't grow with the number of pages.
+SPILL_STORE = None
+# With --format jsonl or sarif, each failure is written to the output file
+# as soon as it is found by this.
+REPORT_STREAM = None
+# GitHub won't accept an issue body longer than this.
+GITHUB_BODY_LIMIT = 65536
+# The extensions of pages that have been precompressed. A page that is only
+# shipped precompressed is checked by decompressing it as it is read, and
+# links to the page find the compressed file.
+COMPRESSED_PAGES = (".gz", ".br")
 STATUS_COUNT = 1
 HTML_CACHE_RESULTS = {}
-DNS_SKIP = []
+# The result code for each external link that has been checked.
+LINK_RESULTS = {}
+# Metrics about the run, written out by --metrics-out. Everything here is
+# cheap enough to collect all of the time.
+METRICS = {
+    "phases": {},
+    "counters": collections.Counter(),
+    "files": {"count": 0, "parse_seconds": 0.0, "validate_seconds": 0.0},
+    # A heap of the (seconds, file) for the slowest files to check
+    "slowest": [],
+    # host -> latency histogram for its requests
+    "hosts": {}
+}
+SLOWEST_FILES = 20
+# The upper bounds, in seconds, of the latency histogram buckets. The last
+# bucket counts anything slower.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# The manifest from the previous run when checking incrementally, and the
+# file entries for the next one.
+MANIFEST_VERSION = 3
+MANIFEST = None
+MANIFEST_FILES = {}
+DNS_SKIP = set()
+# Whether or not each host resolves. Each distinct host is only looked up
+# once; the cache is bounded so that long-running processes don't grow
+# without limit.
+DNS_CACHE = collections.OrderedDict()
+DNS_CACHE_SIZE = 10000
+DNS_CONCURRENCY = 100
+# State shared by the external link checks while they are running: when
+# the next request to each host may start, the consecutive transient
+# failures seen for each host and the overall limit on requests in flight.
+HOST_NEXT_START = {}
+HOST_FAILURES = {}
+REQUEST_SLOTS = None
+# With --deadline, the time.monotonic() by which the web links need to have
+# been checked, and the links that were left unchecked, either because the
+# deadline passed or because the circuit breaker had tripped for the host.
+DEADLINE = None
+UNCHECKED_LINKS = {}
+# With --watch, how long the site has to be left alone before a rebuild is
+# taken to have finished, and how often the site is looked at for changes
+# when inotify can't be used.
+WATCH_SETTLE = 0.2
+WATCH_INTERVAL = 1.0
+# With --watch, the site as it was last checked and the paths that have
+# changed since, or None if they aren't known. The directories and files
+# that haven't changed are taken from the previous check rather than being
+# read and hashed again.
+PREVIOUS_SITE = None
+CHANGED_PATHS = None
+# The rules from --redirects, as compiled by parse_redirect_rule, and a hash
+# of them so that an incremental run can tell if they have changed.
+REDIRECT_RULES = []
+REDIRECT_RULES_HASH = None
+# How many redirects within the site are followed before giving up.
+MAX_REDIRECTS = 10
+# The substitutions that JavaScript's String.replace makes in the
+# replacement string.
+JS_REPLACEMENT = re.compile(r"\$(\$|&|`|'|\d\d?)")
+# With --sitemap or --url-list, the result of fetching each page, so that
+# links to the pages don't need checking again.
+FETCHED_PAGES = {}
+# The most that a page being fetched should have buffered at once: the
+# chunk being parsed plus what aiohttp reads ahead. --max-in-flight-bytes
+# is divided by this to get the number of pages fetched at once.
+PAGE_CHUNK = 65536
+PAGE_BUFFER = 4 * PAGE_CHUNK
+# How deep sitemap indexes can be nested.
+MAX_SITEMAP_DEPTH = 5
+# The version of the partial results written by --shard.
+SHARD_VERSION = 2
+# How many of the directories, extensions and files using the most space
+# are listed after the unreferenced files.
+UNREFERENCED_TOP = 10
+# Hosts that have answered a HEAD with 404/405 for a link that a GET then
+# found; later links on them skip the HEAD and go straight to the GET.
+HEAD_UNSUPPORTED = {}
 VERBOSE = 0
+JOBS = 1
 OUTPUT_FILE = None
 
-def reference_file(filename):
-    """ If filename is in the list, remove it """
-    if filename in ALL_FILES:
-        ALL_FILES.remove(filename)
-        return True
-    return False
+def reference_file(filename, scan=None):
+    """
+    If filename is in the list, mark it as referenced. While a file is being
+    checked, the reference is recorded in that file's results and merged
+    later; otherwise the file is removed from the list straight away.
+    """
+    if filename not in SITE.all_files:
+        return False
+    if scan is None:
+        del SITE.all_files[filename]
+    else:
+        scan["referenced"][filename] = None
+    return True
+
+
+def add_target(scan, path):
+    """
+    Record that the result of checking the file depends on whether or not
+    path exists.
+    """
+    if scan is not None:
+        scan["targets"][os.path.normpath(path)] = None
+
+
+def new_file_scan(filename):
+    """ Return an empty set of results for checking a single file. """
+    return {
+        "file": filename,
+        "failures": {},
+        "links": {},
+        "referenced": {},
+        "targets": {},
+        "prefixes": {},
+        "anchors": {},
+        "fragments": {},
+        "volatile": False,
+        "tags": None,
+        "hash": None,
+        # Whether the page was read, so that its ids are known
+        "parsed": False,
+        # For a fetched page, the URL that its links are relative to
+        "base": None,
+        # False if another shard is checking the file
+        "owned": True,
+        "parse_seconds": 0.0,
+        "validate_seconds": 0.0,
+        "stdout": "",
+        "stderr": "",
+        "exit": None
+    }
+
+
+@contextlib.contextmanager
+def metrics_phase(name):
+    """
+    Record the wall and CPU time taken by a phase of the run. The CPU time
+    of worker processes is recorded separately.
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        yield
+    finally:
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        phase = METRICS["phases"].setdefault(
+            name, {"seconds": 0.0, "cpu_seconds": 0.0, "worker_cpu_seconds": 0.0})
+        phase["seconds"] += time.perf_counter() - start
+        phase["cpu_seconds"] += time.process_time() - cpu_start
+        phase["worker_cpu_seconds"] += max(0.0, (
+            children_end.ru_utime + children_end.ru_stime -
+            children.ru_utime - children.ru_stime))
+
+
+def count_metric(name, value=1):
+    """ Add to one of the counters in the metrics. """
+    METRICS["counters"][name] += value
+
+
+def record_latency(host, seconds):
+    """ Add the time taken by a request to the host's latency histogram. """
+    histogram = METRICS["hosts"].get(host)
+    if histogram is None:
+        histogram = {
+            "requests": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+            "buckets": [0] * (len(LATENCY_BUCKETS) + 1)
+        }
+        METRICS["hosts"][host] = histogram
+    histogram["requests"] += 1
+    histogram["total_seconds"] += seconds
+    histogram["max_seconds"] = max(histogram["max_seconds"], seconds)
+    bucket = 0
+    while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+        bucket += 1
+    histogram["buckets"][bucket] += 1
+    count_metric("external_requests")
+
+
+def record_file_times(scan):
+    """ Add the time taken to check a file to the metrics. """
+    seconds = scan["parse_seconds"] + scan["validate_seconds"]
+    files = METRICS["files"]
+    files["count"] += 1
+    files["parse_seconds"] += scan["parse_seconds"]
+    files["validate_seconds"] += scan["validate_seconds"]
+    if len(METRICS["slowest"]) < SLOWEST_FILES:
+        heapq.heappush(METRICS["slowest"], (seconds, scan["file"]))
+    elif seconds > METRICS["slowest"][0][0]:
+        heapq.heapreplace(METRICS["slowest"], (seconds, scan["file"]))
+
+
+def hit_rate(hits, lookups):
+    """ Return hits as a fraction of lookups, or None if there were none. """
+    if lookups == 0:
+        return None
+    return hits / lookups
+
+
+def write_metrics(metrics_file):
+    """ Write the metrics out as JSON. """
+    counters = METRICS["counters"]
+    metrics = {
+        "phases": METRICS["phases"],
+        "counters": dict(counters),
+        "cache_hit_rates": {
+            "link_cache": hit_rate(
+                counters["link_cache_hits"], counters["link_cache_lookups"]),
+            "manifest_files": hit_rate(
+                counters["manifest_files_reused"],
+                counters["manifest_files_lookups"]),
+            "manifest_links": hit_rate(
+                counters["manifest_links_reused"],
+                counters["manifest_links_lookups"]),
+            "dns": hit_rate(
+                counters["dns_cache_hits"], counters["dns_cache_lookups"])
+        },
+        "files": METRICS["files"],
+        "slowest_files": [
+            {"file": file, "seconds": seconds}
+            for seconds, file in sorted(METRICS["slowest"], reverse=True)
+        ],
+        "latency_buckets": list(LATENCY_BUCKETS),
+        "hosts": METRICS["hosts"]
+    }
+    with open(metrics_file, "w") as myfile:
+        json.dump(metrics, myfile, indent=2)
 
 
 def drop_dot(string_to_check):
@@ -84,50 +423,240 @@ def get_all_html_files(path):
     below.
     """
     result = []
-    for root, dirs, files in os.walk(path):
+    for root, dirs, files in walk_tree(path):
         process_html_files(result, files, root)
+        # This also finds an index.html that is only there precompressed.
+        SITE.dir_index[os.path.normpath(root)] = SITE.file_index.get(
+            os.path.normpath(join(root, "index.html")))
         process_html_dirs(dirs, root)
+    build_prefix_index()
+    if brotli is None:
+        unreadable = [file for file in result if file.endswith(".br")]
+        if unreadable:
+            print("brotli is not installed so %s precompressed pages can't "
+                  "be checked" % len(unreadable))
+            result = [file for file in result if not file.endswith(".br")]
     return result
 
 
+def walk_tree(path):
+    """
+    Walk the tree in the same order as os.walk, recording the size of each
+    file and any symbolic links to directories from the directory entries
+    along the way. As with os.walk, symbolic links to directories are
+    listed but not followed and directories that can't be read are skipped.
+    With --watch, the directories that haven't changed since the previous
+    check are taken from its listings instead of being read again.
+    """
+    changed_dirs = set()
+    if CHANGED_PATHS is not None:
+        changed_dirs = {os.path.dirname(changed) or "." for changed in CHANGED_PATHS}
+    pending = [path]
+    while pending:
+        root = pending.pop()
+        key = os.path.normpath(root)
+        if (PREVIOUS_SITE is not None and key in PREVIOUS_SITE.listings and
+                key not in changed_dirs and not path_changed(key)):
+            dirs, files, below = PREVIOUS_SITE.listings[key]
+            for name in files:
+                file_path = join(root, name)
+                SITE.file_sizes[file_path] = PREVIOUS_SITE.file_sizes[file_path]
+            walked = set(below)
+            for name in dirs:
+                if join(root, name) not in walked:
+                    SITE.symlinked_dirs[os.path.normpath(join(root, name))] = None
+        else:
+            try:
+                dirs, files, below = read_directory(root)
+            except OSError:
+                continue
+        if args.watch:
+            SITE.listings[key] = (dirs, files, below)
+        yield root, dirs, files
+        # Reversed so that the first directory is the next one visited.
+        pending.extend(reversed(below))
+
+
+def build_prefix_index():
+    """ Sort the files found by the walk so that they can be found by prefix. """
+    ordered = sorted((path, order) for order, path in enumerate(SITE.all_files))
+    SITE.sorted_files = [path for path, _ in ordered]
+    SITE.walk_order = [order for _, order in ordered]
+
+
+def find_by_prefix(prefix):
+    """
+    Return the first file found by the walk, and not yet referenced, that
+    starts with prefix, or None if there isn't one.
+    """
+    matched = None
+    index = bisect.bisect_left(SITE.sorted_files, prefix)
+    while index < len(SITE.sorted_files) and SITE.sorted_files[index].startswith(prefix):
+        if (SITE.sorted_files[index] in SITE.all_files and
+                (matched is None or SITE.walk_order[index] < SITE.walk_order[matched])):
+            matched = index
+        index += 1
+    if matched is None:
+        return None
+    return SITE.sorted_files[matched]
+
+
+def read_directory(root):
+    """
+    Return the directories, the files and the directories to walk into
+    (those that aren't symbolic links) in root, recording the size of each
+    file and any symbolic links to directories.
+    """
+    dirs = []
+    files = []
+    below = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+                try:
+                    SITE.file_sizes[entry.path] = entry.stat().st_size
+                except OSError:
+                    # A broken symbolic link takes up no space.
+                    SITE.file_sizes[entry.path] = 0
+            elif entry.is_symlink():
+                dirs.append(entry.name)
+                SITE.symlinked_dirs[os.path.normpath(entry.path)] = None
+            else:
+                dirs.append(entry.name)
+                below.append(entry.path)
+    return dirs, files, below
+
+
+def path_changed(path):
+    """
+    Return whether path, or a directory above it, is one of the paths that
+    --watch saw change. Without a list of the changes, anything could have.
+    """
+    if CHANGED_PATHS is None:
+        return True
+    path = os.path.normpath(path)
+    while path not in ("", os.sep):
+        if path in CHANGED_PATHS:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
 def process_html_files(result, files, root):
     """
     For a given list of files, update the list with
     any that are HTML files.
     """
-    global ALL_FILES # pylint: disable=global-statement
+    compressed = []
     for name in files:
         file_path = os.path.join(root, name)
-        if name.endswith((".html", ".htm")) and \
-            file_path not in result:
-                result.append(file_path)
+        # walk_tree only visits each directory once so there is no need to
+        # check whether the file has already been added.
+        if name.endswith((".html", ".htm")):
+            result.append(file_path)
+        elif compressed_page(name) is not None:
+            compressed.append(file_path)
         # We record ALL of the files that have been found
         # so that we can then remove them when they are
         # referenced and report any files not touched.
-        if file_path not in ALL_FILES:
-            ALL_FILES.append(file_path)
+        SITE.all_files[file_path] = None
+        SITE.file_index[os.path.normpath(file_path)] = file_path
+    # A precompressed page is only checked if the page isn't also there
+    # uncompressed, and then only the first of its compressed copies.
+    for file_path in compressed:
+        page = os.path.normpath(compressed_page(file_path))
+        if page not in SITE.file_index:
+            SITE.file_index[page] = file_path
+            result.append(file_path)
+
+
+def compressed_page(name):
+    """
+    Return the name of the page that name is a precompressed copy of, or
+    None if it isn't one.
+    """
+    page, extension = os.path.splitext(name)
+    if extension in COMPRESSED_PAGES and page.endswith((".html", ".htm")):
+        return page
+    return None
+
+
+def open_page(filename):
+    """
+    Open a page to be read as text. A precompressed page is decompressed as
+    it is read rather than all at once.
+    """
+    if compressed_page(filename) is None:
+        return open(filename, "r")
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt")
+    if brotli is None:
+        raise OSError("brotli is not installed")
+    return io.TextIOWrapper(io.BufferedReader(BrotliReader(open(filename, "rb"))))
+
+
+class BrotliReader(io.RawIOBase):
+    """ Decompresses a brotli file, a chunk at a time, as it is read. """
+
+    def __init__(self, compressed):
+        super().__init__()
+        self.compressed = compressed
+        self.decompressor = brotli.Decompressor()
+        self.pending = b""
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset == len(self.pending):
+            chunk = self.compressed.read(PAGE_CHUNK)
+            if not chunk:
+                if not self.decompressor.is_finished():
+                    raise EOFError("Compressed file ended before the "
+                                   "end-of-stream marker was reached")
+                return 0
+            self.pending = self.decompressor.process(chunk)
+            self.offset = 0
+        size = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:size] = self.pending[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        self.compressed.close()
+        super().close()
 
 
 def process_html_dirs(dirs, root):
     """
     For a given list of directories, check that none of the directories
     has a full-stop in the name. Note that we do not need to recurse
-    through the directories because os.walk does that already for all of
+    through the directories because walk_tree does that already for all of
     the files.
     """
-    global FAILED_DIRS # pylint: disable=global-statement
     for directory in dirs:
         if "." in directory:
-            path = join(root, directory)
-            if path not in FAILED_DIRS:
-                FAILED_DIRS.append(path)
+            record_failed_dir(join(root, directory))
 
 
-def validate_file_link(filename, text):
+def record_failed_dir(path):
+    """ Record a directory with a full-stop in its name. """
+    if path not in SITE.failed_dirs:
+        SITE.failed_dirs[path] = None
+        stream_failure(failure_record(path, None, "dir", error="invalid-name"))
+
+
+def validate_file_link(filename, text, scan, check_fragment=False):
     """ Check that the specified file-based object exists. """
     # If there is an anchor (#) in the text, we need to look at what
     # comes before it.
-    text = text.split("#")[0]
+    text, _, fragment = text.partition("#")
     # If there is a query (?) in the text, we need to look at what
     # comes before it.
     text = text.split("?")[0]
@@ -168,68 +697,303 @@ def validate_file_link(filename, text):
         combined_path = unescaped_path
         if VERBOSE >= 2:
             print("Unescaped file: %s" % unescaped_path)
-    # needs to be a file or directory ... but if it is a directory, that means
-    # the path didn't end with a "/" (because we would have added index.html)
-    # so we now add that back to the path so that the file referencing process
-    # correctly marks the file as referenced.
-    if os.path.isfile(combined_path):
-        reference_file(combined_path)
+    found = lookup_path(combined_path, scan)
+    if found is None and REDIRECT_RULES:
+        found, web_link = follow_redirects(combined_path, scan)
+        if web_link is not None:
+            # The redirect goes to another site, so check it there.
+            if not args.noexternal:
+                scan["links"][web_link] = None
+            return None
+    if found is None:
+        return combined_path
+    reference_file(found, scan)
+    if check_fragment:
+        add_fragment(scan, found, fragment)
+    return None
+
+
+def load_redirect_rules(rules_file):
+    """
+    Load the rules that the redirect Lambda (lambda-redirect) is deployed
+    with, returning them compiled and a hash of them.
+    """
+    with open(rules_file, "rb") as myfile:
+        data = myfile.read()
+    rules = [parse_redirect_rule(rule) for rule in json.loads(data)]
+    return rules, hashlib.sha1(data).hexdigest()
+
+
+def parse_redirect_rule(rule):
+    """
+    Compile a rule the same way as parseRules in lambda-redirect/rules.js.
+    A rule is "pattern replacement [flags]", where the pattern is a regular
+    expression and can be prefixed with ! to invert it.
+    """
+    parts = re.sub(r"\s+", " ", rule).split(" ")
+    flags = ""
+    match = re.search(r"\[([^\]]+)]$", rule)
+    if match is not None:
+        flags = match.group(1)
+    pattern = parts[0]
+    inverted = pattern[:1] == "!"
+    if inverted:
+        pattern = pattern[1:]
+    # JavaScript names groups with (?<name>...) rather than (?P<name>...)
+    pattern = re.sub(r"\(\?<(?![=!])", "(?P<", pattern)
+    # As in rules.js, NC and G only apply if the flags are there as their
+    # own part of the rule.
+    has_flags = len(parts) > 2
+    redirect = re.search(r"R=?(\d+)?", flags)
+    host = re.search(r"H=([^,]+)", flags)
+    return {
+        "regexp": re.compile(
+            pattern, re.IGNORECASE if has_flags and "NC" in flags else 0),
+        "global": has_flags and "G" in flags,
+        # JavaScript turns a missing replacement into "undefined".
+        "replace": parts[1] if len(parts) > 1 else "undefined",
+        "inverted": inverted,
+        "last": "L" in flags,
+        "redirect": int(redirect.group(1) or 301) if redirect else None,
+        "forbidden": "F" in flags,
+        "host": re.compile(host.group(1)) if host else None
+    }
+
+
+def js_replace(rule, string):
+    """ Replace the rule's pattern in string as JavaScript would. """
+    def expand(match):
+        def substitute(token):
+            value = token.group(1)
+            if value == "$":
+                return "$"
+            if value == "&":
+                return match.group(0)
+            if value == "`":
+                return string[:match.start()]
+            if value == "'":
+                return string[match.end():]
+            # $nn is only a two digit group if there are that many groups.
+            suffix = ""
+            if len(value) == 2 and int(value) > rule["regexp"].groups:
+                value, suffix = value[0], value[1]
+            if 1 <= int(value) <= rule["regexp"].groups:
+                return (match.group(int(value)) or "") + suffix
+            return token.group(0)
+        return JS_REPLACEMENT.sub(substitute, rule["replace"])
+    return rule["regexp"].sub(expand, string, count=0 if rule["global"] else 1)
+
+
+def apply_redirect_rules(uri):
+    """
+    Work out what the redirect Lambda does with a request for the URI, as
+    applyRules in lambda-redirect/index.js does. Returns a status and the
+    redirect location for a redirect, 403 and None if the request is
+    forbidden or None and the (possibly rewritten) URI otherwise. Returns
+    None if the Lambda would fail. Rules for a particular host are skipped
+    because links within the site don't say which host they are for.
+    """
+    # Directories can't have full-stops in them so a URI without one is a
+    # directory; the Lambda adds the index.html.
+    if "." not in uri:
+        uri += "index.html" if uri[-1:] == "/" else "/index.html"
+    # A rewrite after a redirect changes the URI but the response is still
+    # the redirect.
+    status = None
+    location = None
+    target = uri
+    for rule in REDIRECT_RULES:
+        if rule["host"] is not None:
+            continue
+        if rule["regexp"].search(uri) is None:
+            if rule["inverted"]:
+                target = rule["replace"]
+                if rule["last"]:
+                    break
+            continue
+        if rule["forbidden"]:
+            status, location = 403, None
+        elif rule["redirect"] is not None:
+            status, location = rule["redirect"], js_replace(rule, uri)
+        elif rule["inverted"]:
+            # index.js doesn't return anything for this case, which makes
+            # the Lambda fail.
+            return None
+        elif rule["replace"] != "-":
+            target = js_replace(rule, uri)
+        if rule["last"]:
+            break
+    if status is not None:
+        return status, location
+    return None, target
+
+
+def follow_redirects(path, scan):
+    """
+    When the path isn't in the site, see if the redirect rules make it
+    work. Returns the file that ends up being served, if any, and the web
+    link if it ends up redirecting to another site.
+    """
+    for _ in range(MAX_REDIRECTS):
+        uri = os.path.normpath(path)
+        if uri == ".":
+            uri = ""
+        uri = "/" + uri
+        if path[-1] == "/":
+            uri = uri.rstrip("/") + "/"
+        outcome = apply_redirect_rules(uri)
+        if outcome is None or outcome[1] is None:
+            return None, None
+        status, target = outcome
+        target = target.split("#")[0].split("?")[0]
+        if status is None:
+            if target == uri or target == "":
+                return None, None
+            # A rewrite serves the other file without the browser knowing.
+            return lookup_path("." + target, scan), None
+        if as_web_link(target) is not None:
+            return None, as_web_link(target)
+        if target[:1] == "/":
+            path = "." + target
+        else:
+            path = join(os.path.dirname("." + uri), target)
+        found = lookup_path(path, scan)
+        if found is not None:
+            return found, None
+    return None, None
+
+
+def lookup_path(path, scan=None):
+    """
+    Find the file that path refers to. It needs to be a file or directory
+    ... but if it is a directory, that means the path didn't end with a "/"
+    (because we would have added index.html) so the directory's index.html
+    is returned so that the file referencing process correctly marks the
+    file as referenced. Returns None if there isn't a matching file.
+    """
+    key = os.path.normpath(path)
+    add_target(scan, key)
+    if key in SITE.file_index:
+        return SITE.file_index[key]
+    if key in SITE.dir_index:
+        add_target(scan, join(key, "index.html"))
+        return SITE.dir_index[key]
+    if not outside_index(key):
         return None
-    if os.path.isdir(combined_path):
+    # Changes outside of the index can't be tracked so the results for
+    # this file can't be reused by an incremental run.
+    if scan is not None:
+        scan["volatile"] = True
+    if os.path.isfile(path):
+        return path
+    if os.path.isdir(path):
         # Is there a "index.html" inside that folder?
-        temp_path = f"{combined_path}/index.html"
+        temp_path = f"{path}/index.html"
         if os.path.isfile(temp_path):
-            reference_file(temp_path)
-            return None
-    return combined_path
+            return temp_path
+    return None
+
+
+def outside_index(key):
+    """
+    Check if the normalised path is somewhere that the walk didn't index,
+    i.e. above the scanned directory or below a symbolic link.
+    """
+    if os.path.isabs(key) or key == ".." or key.startswith("../"):
+        return True
+    while SITE.symlinked_dirs and key != "":
+        if key in SITE.symlinked_dirs:
+            return True
+        key = os.path.dirname(key)
+    return False
+
+
+def skip_prefixes(skip_list):
+    """
+    Sort the skip list and drop any entry that starts with another entry.
+    That leaves the greatest entry that sorts before some text as the only
+    one that could be a prefix of it, which matched_skip relies on.
+    """
+    if skip_list is None:
+        return None
+    prefixes = []
+    for skip in sorted(skip_list):
+        if not prefixes or not skip.startswith(prefixes[-1]):
+            prefixes.append(skip)
+    return tuple(prefixes)
 
 
 def matched_skip(text, skip_list):
-    """ Check if text is in the skip list. """
+    """ Check if text is in the skip list, as prepared by skip_prefixes. """
     if skip_list is not None:
-        for skip in skip_list:
-            if text.startswith(skip):
-                return True
+        index = bisect.bisect_right(skip_list, text)
+        if index > 0 and text.startswith(skip_list[index - 1]):
+            return True
     return False
 
 
-def validate_link(filename, text, check_unrefs_only=False):
+def validate_link(filename, text, scan, check_unrefs_only=False):
     """ Main link validation processor. """
-    global FILE_LINK_PAIRS # pylint: disable=global-statement
-    global UNIQUE_LINKS # pylint: disable=global-statement
     # Clean up the text first ...
     if text is not None:
         text = text.strip()
-    if text is None or text == "" or text[0] == "#":
+    if text is None or text == "":
+        return None
+    if text[0] == "#":
         # or matched_redirect(text):
+        if not check_unrefs_only:
+            add_fragment(scan, filename, text[1:])
         return None
-    # Some links don't have the transport on them to ensure that they work
-    # whether the user is coming via http or https, so add it if it is
-    # missing.
-    if len(text) > 2 and text[:2] == "//":
-        text = "https:" + text
     # Check the URL to see if it is a web link - that is all we check.
-    obj = urlparse(text)
-    if not args.noexternal and (obj.scheme == "http" or obj.scheme == "https"):
+    web_link = as_web_link(text)
+    if not args.noexternal and web_link is not None:
         # If we are checking unreferenced files, don't worry about
         # external links.
         if check_unrefs_only:
             return None
         # We use "file_link_pairs" to track which files reference which
         # URLs - we only check URLs *once* but then flag up all
-        # refernces to the link.
-        if [filename, text] not in FILE_LINK_PAIRS:
-            FILE_LINK_PAIRS.append([filename, text])
-        # ... only check the links once!
-        if text not in UNIQUE_LINKS:
-            UNIQUE_LINKS.append(text)
+        # refernces to the link. The list of unique links is built up
+        # when the file's results are merged.
+        scan["links"][web_link] = None
         return None  # Postpone the decision for now ...
-    if not args.nointernal and obj.scheme == "":
-        return validate_file_link(filename, text)
+    if not args.nointernal and urlparse(text).scheme == "":
+        if scanning_urls():
+            return validate_page_link(filename, text, scan, check_unrefs_only)
+        return validate_file_link(filename, text, scan, not check_unrefs_only)
     # If skipping stuff, return the answer of no problems ...
     return None
 
 
+def validate_page_link(page, text, scan, check_unrefs_only):
+    """
+    When checking pages fetched from a site, there are no files to look at
+    so links within the site are checked along with the web links.
+    """
+    if check_unrefs_only:
+        return None
+    target, _, fragment = urljoin(scan["base"] or page, text).partition("#")
+    add_fragment(scan, target, fragment)
+    if not args.noexternal:
+        scan["links"][target] = None
+    return None
+
+
+def as_web_link(text):
+    """
+    If the link is to a web page, return it as it is checked, otherwise
+    return None.
+    """
+    # Some links don't have the transport on them to ensure that they work
+    # whether the user is coming via http or https, so add it if it is
+    # missing.
+    if len(text) > 2 and text[:2] == "//":
+        text = "https:" + text
+    if urlparse(text).scheme in ("http", "https"):
+        return text
+    return None
+
+
 def output_status(code, value):
     """ Output the status in blocks of 100 """
     global STATUS_COUNT # pylint: disable=global-statement
@@ -243,250 +1007,1267 @@ def output_status(code, value):
     return value
 
 
+class RetryableStatus(Exception):
+    """
+    Raised when a server responds with a status that means the request is
+    worth trying again. It carries the result the response would give if
+    there are no retries left.
+    """
+
+    def __init__(self, response, result):
+        super().__init__(response.status)
+        self.status = response.status
+        self.retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        self.result = result
+
+
+# Errors and response statuses that are likely to be transient, so are
+# retried. A link that still fails once its retries are used up counts
+# towards its host's circuit breaker, unless the failure is a 429.
+RETRY_ERRORS = (
+    aiohttp.client_exceptions.ClientConnectorError,
+    aiohttp.client_exceptions.ServerDisconnectedError,
+    asyncio.TimeoutError
+)
+RETRY_STATUSES = (429, 503)
+
+
+def parse_retry_after(value):
+    """
+    Convert a Retry-After header, which is either a number of seconds or an
+    HTTP date, into a number of seconds. Returns None if there isn't one.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(0, when.timestamp() - time.time())
+
+
+def check_retryable(response, result):
+    """ Raise RetryableStatus if the response is worth retrying. """
+    if response.status in RETRY_STATUSES:
+        raise RetryableStatus(response, result)
+
+
+async def async_ranged_get(session, url):
+    """
+    Check the URL with a GET for just its first byte. The body is never
+    read: unless the server sent no more than the byte asked for, the
+    connection is closed as soon as the status has arrived.
+    """
+    count_metric("ranged_gets")
+    async with session.get(
+            url,
+            allow_redirects=True,
+            headers=RANGED_GET) as response:
+        if response.status != 404 and response.status != 405:
+            result = ('.', 0)
+        else:
+            result = ('X', response.status)
+        check_retryable(response, result)
+        if response.content_length is None or response.content_length > 1:
+            response.close()
+        return result
+
+
 async def async_url_validation(session, url):
-    """ Validate the URL. """
+    """
+    Validate the URL, returning the status character and result value.
+    """
+    host = urlsplit(url).netloc.lower()
+    if host in HEAD_UNSUPPORTED:
+        count_metric("head_requests_skipped")
+        return await async_ranged_get(session, url)
     async with session.head(
             url,
             allow_redirects=True,
             headers=CHROME) as response:
         if response.status == 404 or response.status == 405:
             # Some sites return 404/405 for HEAD requests, so we need to
-            # double-check with a full request.
-            async with session.get(
-                    url,
-                    allow_redirects=True,
-                    headers=CHROME) as response:
-                if response.status != 404 and response.status != 405:
-                    return output_status('.', 0)
-                return output_status('X', response.status)
+            # double-check with a GET.
+            result = await async_ranged_get(session, url)
+            if response.status == 405 or result[1] == 0:
+                HEAD_UNSUPPORTED[host] = None
+            return result
         else:
             if (response.status < 400 or
                     response.status > 499):
-                return output_status('.', 0)
-            if VERBOSE >= 3:
-                print(response.status, response.url)
-            # We only really care about full-on failures, i.e. 404.
-            # Other status codes can be returned just because we aren't
-            # using a browser, even if we do provide the agent string
-            # for Chrome.
-            return output_status('_', 0)
+                result = ('.', 0)
+            else:
+                if VERBOSE >= 3:
+                    print(response.status, response.url)
+                # We only really care about full-on failures, i.e. 404.
+                # Other status codes can be returned just because we aren't
+                # using a browser, even if we do provide the agent string
+                # for Chrome.
+                result = ('_', 0)
+            check_retryable(response, result)
+            return result
+
+
+def dns_check_host(url):
+    """
+    Return the host that needs to resolve for the URL to be valid, or None
+    if the host is in the DNS skip list.
+    """
+    parts = urlparse(url)
+    if parts.netloc in DNS_SKIP or parts.hostname in DNS_SKIP:
+        return None
+    # An empty host can never resolve.
+    return parts.hostname or ""
+
+
+async def resolve_host(host, semaphore):
+    """
+    Resolve the host without blocking the event loop, caching the result.
+    """
+    async with semaphore:
+        if host in DNS_CACHE:
+            DNS_CACHE.move_to_end(host)
+            return DNS_CACHE[host]
+        resolves = False
+        count_metric("dns_lookups")
+        if host != "":
+            try:
+                await asyncio.get_running_loop().getaddrinfo(
+                    host, None, family=socket.AF_INET)
+                resolves = True
+            except (socket.gaierror, UnicodeError):
+                pass
+        if not resolves:
+            count_metric("dns_failures")
+        DNS_CACHE[host] = resolves
+        if len(DNS_CACHE) > DNS_CACHE_SIZE:
+            DNS_CACHE.popitem(last=False)
+        return resolves
+
+
+async def resolve_hosts(links):
+    """
+    Resolve each of the distinct hosts used by the links concurrently so
+    that the links themselves don't have to wait on the resolver.
+    """
+    hosts = {}
+    for link in links:
+        host = dns_check_host(link)
+        if host is not None:
+            count_metric("dns_cache_lookups")
+            if host in DNS_CACHE:
+                count_metric("dns_cache_hits")
+            else:
+                hosts[host] = None
+    semaphore = asyncio.Semaphore(DNS_CONCURRENCY)
+    await asyncio.gather(*[resolve_host(host, semaphore) for host in hosts])
 
 
 async def async_check_link(session, url):
     """ Check the external link. """
-    # Check that the host resolves, but only if it isn't in the DNS skip list
-    parts = urlparse(url)
-    if parts.netloc not in DNS_SKIP:
-        try:
-            _ = socket.gethostbyname(parts.netloc)
-        except socket.gaierror as err:
+    # Check that the host resolves, but only if it isn't in the DNS skip list.
+    # The hosts have normally been resolved already by resolve_hosts.
+    host = dns_check_host(url)
+    if host is not None:
+        if host in DNS_CACHE:
+            resolves = DNS_CACHE[host]
+        else:
+            resolves = await resolve_host(host, asyncio.Semaphore())
+        if not resolves:
             return output_status('D', 1)
-    # Now try to validate the URL
-    try:
-        return await async_url_validation(session, url)
+    # Now try to validate the URL, retrying transient failures
+    host = urlparse(url).netloc.lower()
+    attempt = 1
+    while True:
+        # Once a host has failed too many times in a row, stop sending it
+        # requests. The link is reported as unchecked.
+        if (args.circuit_breaker and
+                HOST_FAILURES.get(host, 0) >= args.circuit_breaker):
+            count_metric("circuit_breaker_skips")
+            return output_status('j', None)
+        retry_after = None
+        try:
+            await wait_host_turn(host)
+            async with REQUEST_SLOTS:
+                start = time.perf_counter()
+                try:
+                    result = await async_url_validation(session, url)
+                finally:
+                    record_latency(host, time.perf_counter() - start)
+            HOST_FAILURES[host] = 0
+            return output_status(*result)
+        except RetryableStatus as exception:
+            if attempt > args.retries:
+                result = output_status(*exception.result)
+                # Being rate limited doesn't mean that the host is down, and
+                # Retry-After already slows the requests down.
+                if exception.status != 429:
+                    record_host_failure(host, result)
+                return result
+            retry_after = exception.retry_after
+        except ERRORS_HANDLED as exception:
+            if isinstance(exception, asyncio.TimeoutError):
+                count_metric("external_timeouts")
+            if not isinstance(exception, RETRY_ERRORS):
+                return error_result(url, exception)
+            if attempt > args.retries:
+                return record_host_failure(host, error_result(url, exception))
+        count_metric("external_retries")
+        await asyncio.sleep(retry_delay(attempt, retry_after))
+        attempt += 1
+
+
+def record_host_failure(host, result):
+    """
+    Count a link that has used up its retries towards its host's circuit
+    breaker, unless the result is one that is treated as OK. Returns the
+    result.
+    """
+    if result != 0:
+        HOST_FAILURES[host] = HOST_FAILURES.get(host, 0) + 1
+    return result
+
+
+def retry_delay(attempt, retry_after):
+    """
+    How long to wait before the next attempt: what the server asked for if
+    it sent Retry-After, otherwise exponential backoff with full jitter.
+    Either way, the wait is capped at --retry-max-delay.
+    """
+    if retry_after is not None:
+        return min(retry_after, args.retry_max_delay)
+    backoff = args.retry_backoff * 2 ** (attempt - 1)
+    return random.uniform(0, min(backoff, args.retry_max_delay))
+
+
+# All of the errors that checking a link can report on.
+ERRORS_HANDLED = (
+    socket.gaierror,
+    aiohttp.client_exceptions.ClientOSError,
+    aiohttp.client_exceptions.ServerDisconnectedError,
+    aiohttp.client_exceptions.ClientResponseError,
+    concurrent.futures._base.CancelledError, # pylint: disable=protected-access
+    concurrent.futures._base.TimeoutError, # pylint: disable=protected-access
+    asyncio.TimeoutError
+)
+
+
+def error_result(url, exception):
+    """ Output and return the result for an error checking the URL. """
     # (Non-)Fatal errors
-    except socket.gaierror as err:
-        print("Error while checking %s: %s" % (url, err))
+    if isinstance(exception, socket.gaierror):
+        print("Error while checking %s: %s" % (url, exception))
         return output_status('a', -2)
     # Non-fatal errors, but indicate which error we are getting
-    except aiohttp.client_exceptions.ClientConnectorError:
+    if isinstance(exception, aiohttp.client_exceptions.ClientConnectorError):
         return output_status('b', -3)
-    except aiohttp.client_exceptions.ServerTimeoutError:
+    if isinstance(exception, aiohttp.client_exceptions.ServerTimeoutError):
         return output_status('c', -4)
-    except concurrent.futures._base.CancelledError: # pylint: disable=protected-access
+    if isinstance(exception, concurrent.futures._base.CancelledError): # pylint: disable=protected-access
         return output_status('d', -5)
-    except concurrent.futures._base.TimeoutError: # pylint: disable=protected-access
+    if isinstance(exception, concurrent.futures._base.TimeoutError): # pylint: disable=protected-access
         return output_status('e', -6)
-    except aiohttp.client_exceptions.ClientOSError:
+    if isinstance(exception, aiohttp.client_exceptions.ClientOSError):
         return output_status('f', -7)
-    except aiohttp.client_exceptions.ServerDisconnectedError:
+    if isinstance(exception, aiohttp.client_exceptions.ServerDisconnectedError):
         return output_status('g', -8)
-    except aiohttp.client_exceptions.ClientResponseError:
+    if isinstance(exception, aiohttp.client_exceptions.ClientResponseError):
         return output_status('h', -9)
-    except asyncio.TimeoutError:
-        return output_status('i', -10)
+    return output_status('i', -10)
+
+
+async def wait_host_turn(host):
+    """ Wait until the next request to the host is allowed to start. """
+    now = asyncio.get_running_loop().time()
+    start = max(now, HOST_NEXT_START.get(host, now))
+    HOST_NEXT_START[host] = start + args.per_host_delay
+    if start > now:
+        await asyncio.sleep(start - now)
+
+
+async def schedule_checks(session, links):
+    """
+    Check the links without flooding any one host. Each host gets no more
+    than --per-host-limit requests in flight and requests to it are started
+    at least --per-host-delay seconds apart. The hosts take turns at the
+    overall --max-connections limit so that a page full of links to one
+    site doesn't hold everything else up. Returns the results in the same
+    order as the links.
+    """
+    global REQUEST_SLOTS # pylint: disable=global-statement
+    REQUEST_SLOTS = asyncio.Semaphore(args.max_connections)
+    HOST_NEXT_START.clear()
+    HEAD_UNSUPPORTED.clear()
+    HOST_FAILURES.clear()
+    queues = collections.OrderedDict()
+    for i, link in enumerate(links):
+        queues.setdefault(urlparse(link).netloc.lower(), collections.deque()).append(i)
+    results = [None] * len(links)
+
+    async def host_worker(queue):
+        """ Work through the links for one host. """
+        while queue:
+            if DEADLINE is not None and time.monotonic() >= DEADLINE:
+                return
+            i = queue.popleft()
+            results[i] = await async_check_link(session, links[i])
+
+    # Start the workers round-robin across the hosts: the first worker for
+    # every host, then the second worker for every host, and so on.
+    workers = []
+    for number in range(args.per_host_limit):
+        for queue in queues.values():
+            if number < len(queue):
+                workers.append(host_worker(queue))
+    if DEADLINE is None:
+        await asyncio.gather(*workers)
+    else:
+        # Any checks still running when the deadline passes are cancelled,
+        # leaving their results as None.
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*workers), max(0, DEADLINE - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+    return results
 
 
 async def async_check_web(session, links):
     """ Check all external links. """
-    results = await asyncio.gather(
-        *[async_check_link(session, url) for url in links]
-    )
+    await resolve_hosts(links)
+    results = await schedule_checks(session, links)
     # That gets us a collection of the responses, matching up to each of
-    # the tasks, so loop through the links again and the index counter
-    # will point to the corresponding result.
-    i = 0
+    # the links. A link that wasn't checked, because the deadline passed or
+    # its host's circuit breaker tripped, has no result and is left out.
+    checked = {}
+    for link, result in zip(links, results):
+        if result is not None:
+            record_link_result(link, result)
+            checked[link] = result
+    return checked
+
+
+def record_link_result(link, result):
+    """
+    Record the result of checking a link. 0 means the link is fine, a
+    positive value is a failure and a negative value is an error that
+    isn't reported.
+    """
+    if result >= 0:
+        LINK_RESULTS[link] = result
+    if link not in HTML_CACHE_RESULTS:
+        if result == 0:
+            HTML_CACHE_RESULTS[link] = None
+        elif result > 0:
+            HTML_CACHE_RESULTS[link] = "%s [%d]" % (link, result)
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalise_url(url):
+    """
+    Normalise a URL so that different spellings of the same resource are
+    only checked once and share the same entry in the link cache: the
+    scheme and host are lowercased, default ports and the fragment are
+    dropped and, with --canonical-query, the query parameters are sorted.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if parts.hostname is None:
+        netloc = parts.netloc.lower()
+    else:
+        netloc = parts.hostname
+        if ":" in netloc:
+            netloc = "[%s]" % netloc
+        if port is not None and port != DEFAULT_PORTS.get(scheme):
+            netloc += ":%s" % port
+        if "@" in parts.netloc:
+            netloc = parts.netloc.rpartition("@")[0] + "@" + netloc
+    query = parts.query
+    if args.canonical_query:
+        query = "&".join(sorted(param for param in query.split("&") if param))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def canonical_groups(links):
+    """
+    Group the links by their normalised URL, in the order they were found,
+    so that each group only needs to be checked once.
+    """
+    groups = {}
     for link in links:
-        if link not in HTML_CACHE_RESULTS:
-            if results[i] == 0:
-                HTML_CACHE_RESULTS[link] = None
-            elif results[i] > 0:
-                HTML_CACHE_RESULTS[link] = "%s [%d]" % (link, results[i])
-        i += 1
+        groups.setdefault(normalise_url(link), []).append(link)
+    return groups
 
 
-async def check_unique_links():
+def open_link_cache(cache_file):
+    """ Open (creating if necessary) the on-disk cache of link results. """
+    cache = sqlite3.connect(cache_file)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS links ("
+        "url TEXT PRIMARY KEY, result INTEGER NOT NULL, checked REAL NOT NULL)")
+    cache.execute(
+        "CREATE INDEX IF NOT EXISTS links_checked ON links (checked)")
+    return cache
+
+
+def load_cached_results(cache, links):
     """
-    Perform an async check of all of the web links we've collected then
-    build up a list of the affected files for the faulty links.
+    Return the cached result for each of the links that has one which
+    hasn't expired. Successes and failures expire after different times.
     """
-    global STATUS_COUNT # pylint: disable=global-statement
-    STATUS_COUNT = 1
+    now = time.time()
+    fresh = {}
+    rows = cache.execute(
+        "SELECT url, result FROM links WHERE "
+        "(result = 0 AND checked >= ?) OR (result > 0 AND checked >= ?)",
+        (now - args.cache_ttl, now - args.cache_failure_ttl))
+    for url, result in rows:
+        fresh[url] = result
+    cached = {}
+    for link in links:
+        key = normalise_url(link)
+        if key in fresh:
+            cached[link] = fresh[key]
+    return cached
+
 
-    web_failed_links = []
-    print("Checking %s web links ..." % len(UNIQUE_LINKS))
+def save_cached_results(cache, results):
+    """
+    Store the results of the links that have just been checked, then drop
+    the oldest entries if the cache has grown beyond its maximum size.
+    Errors (negative results) are transient so they are not cached.
+    """
+    now = time.time()
+    with cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO links (url, result, checked) "
+            "VALUES (?, ?, ?)",
+            [(normalise_url(link), result, now)
+             for link, result in results.items() if result >= 0])
+        (count,) = cache.execute("SELECT COUNT(*) FROM links").fetchone()
+        if count > args.cache_max_entries:
+            cache.execute(
+                "DELETE FROM links WHERE url IN "
+                "(SELECT url FROM links ORDER BY checked LIMIT ?)",
+                (count - args.cache_max_entries,))
+
+
+def open_session():
+    """ Return the HTTP session for checking links and fetching pages. """
     # Force IPv4 only to avoid
     # https://stackoverflow.com/questions/40347726/python-3-5-asyincio-and-aiohttp-errno-101-network-is-unreachable
     conn = aiohttp.TCPConnector(
         family=socket.AF_INET,
         ssl=False,
-        limit=500
+        limit=args.max_connections,
+        limit_per_host=args.per_host_limit
     )
     timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(connector=conn,
-                                     timeout=timeout) as session:
-        await async_check_web(session, UNIQUE_LINKS)
-    for pair in FILE_LINK_PAIRS:
-        # p[0] is the file path and p[1] is the URL.
-        if (pair[1] in HTML_CACHE_RESULTS and
-                HTML_CACHE_RESULTS[pair[1]] is not None):
-            error = [pair[0], HTML_CACHE_RESULTS[pair[1]]]
-            if error not in web_failed_links:
-                web_failed_links.append(error)
+    return aiohttp.ClientSession(
+        connector=conn, timeout=timeout, read_bufsize=PAGE_CHUNK)
+
+
+async def check_unique_links():
+    """
+    Perform an async check of all of the web links we've collected then
+    build up a list of the affected files for the faulty links.
+    """
+    global STATUS_COUNT # pylint: disable=global-statement
+    STATUS_COUNT = 1
+
+    # Only the first spelling of each canonical URL gets checked, and its
+    # result is then given to all of the others.
+    groups = canonical_groups(UNIQUE_LINKS)
+    # When sharding, each shard only checks its share of the links.
+    groups = {key: links for key, links in groups.items() if in_shard(key)}
+    to_check = [links[0] for links in groups.values()]
+    saved = sum(len(links) for links in groups.values()) - len(to_check)
+    count_metric("canonical_requests_saved", saved)
+    if saved:
+        print("Canonicalising the web links saved %s requests" % saved)
+    results = {}
+    # When checking incrementally, only links that weren't in the previous
+    # run get checked.
+    if MANIFEST is not None:
+        known = 0
+        for link in to_check:
+            if link in MANIFEST["external"]:
+                results[link] = MANIFEST["external"][link]
+                known += 1
+        count_metric("manifest_links_lookups", len(to_check))
+        count_metric("manifest_links_reused", known)
+        to_check = [link for link in to_check if link not in MANIFEST["external"]]
+        print("Using results from the previous run for %s web links" % known)
+    if FETCHED_PAGES:
+        fetched = {
+            link: FETCHED_PAGES[link] for link in to_check if link in FETCHED_PAGES
+        }
+        results.update(fetched)
+        to_check = [link for link in to_check if link not in fetched]
+        print("Using the results of fetching pages for %s web links" %
+              len(fetched))
+    cache = None
+    if args.cache_file is not None:
+        cache = open_link_cache(args.cache_file)
+        cached = load_cached_results(cache, to_check)
+        results.update(cached)
+        count_metric("link_cache_lookups", len(to_check))
+        count_metric("link_cache_hits", len(cached))
+        to_check = [link for link in to_check if link not in cached]
+        print("Using cached results for %s web links" % len(cached))
+    if DEADLINE is not None:
+        to_check = prioritise_links(to_check, groups, cache)
+    print("Checking %s web links ..." % len(to_check))
+    checked = {}
+    if to_check:
+        async with open_session() as session:
+            checked = await async_check_web(session, to_check)
+    if cache is not None:
+        save_cached_results(cache, checked)
+        cache.close()
+    results.update(checked)
+    for links in groups.values():
+        if links[0] not in results:
+            # The link couldn't be checked.
+            UNCHECKED_LINKS.update(dict.fromkeys(links))
+            continue
+        for link in links:
+            record_link_result(link, results[links[0]])
+    if UNCHECKED_LINKS:
+        print("\n%s web links were left unchecked because the deadline "
+              "passed or their host kept failing" %
+              (len(to_check) - len(checked)))
+        count_metric("links_unchecked", len(to_check) - len(checked))
+    return web_link_failures()
+
+
+def prioritise_links(links, groups, cache):
+    """
+    Put the links in the order they should be checked in, so that the ones
+    that matter most have been checked if the deadline passes: links that
+    have never been checked before come first, then the links found on the
+    most pages. Otherwise the links stay in the order they were found.
+    """
+    spellings = {group[0]: group for group in groups.values()}
+    pages = collections.Counter(link for _, link in file_link_pairs())
+    seen = set() if cache is None else previously_checked(cache, links)
+    return sorted(links, key=lambda link: (
+        link in seen, -sum(pages[spelling] for spelling in spellings[link])))
+
+
+def previously_checked(cache, links):
+    """ Return the links that are in the cache, even if they have expired. """
+    urls = {url for (url,) in cache.execute("SELECT url FROM links")}
+    return {link for link in links if normalise_url(link) in urls}
+
+
+def web_link_failures():
+    """ Return the (file, failure) pairs for the web links that failed. """
+    web_failed_links = {}
+    for file, link in file_link_pairs():
+        if HTML_CACHE_RESULTS.get(link) is not None:
+            status = LINK_RESULTS[link]
+            # A result of 1 means that the host doesn't resolve.
+            failure = failure_record(
+                file, link, "external", status,
+                "dns" if status == 1 else "http")
+            web_failed_links[failure_key(failure)] = failure
     return web_failed_links
 
 
 def check_file(filename, skip_list):
     """
     For the specified file, read it in and then check all of the links
-    in it.
+    in it. Returns the results for the file; nothing global is changed.
     """
+    scan = new_file_scan(filename)
     if matched_skip(filename, skip_list):
-        return []
+        return scan
 
-    file_failed_links = []
     try:
-        with open(filename, "r") as myfile:
-            data = myfile.read()
-        soup = BeautifulSoup(data, 'html.parser')
-        check_links(filename, soup, file_failed_links)
-        check_linked_images(filename, soup, file_failed_links)
-        check_remaining_references(filename, soup)
+        start = time.perf_counter()
+        with open_page(filename) as myfile:
+            tags = group_tags(EXTRACTORS[args.parser](myfile))
+        scan["parse_seconds"] = time.perf_counter() - start
+        # Keep the extracted tags for the manifest so that the links can
+        # be validated again without having to parse the file.
+        if keeping_manifest():
+            scan["tags"] = tags
+        start = time.perf_counter()
+        if in_shard(filename):
+            validate_tags(filename, tags, scan)
+        else:
+            scan["owned"] = False
+            collect_web_links(tags, scan)
+        scan["validate_seconds"] = time.perf_counter() - start
     except Exception as exception: # pylint: disable=broad-except
         print(f"FAILED TO READ '{filename}'")
         traceback.print_exc()
-    return file_failed_links
+    return scan
 
 
-def check_remaining_references(filename, soup):
+def collect_web_links(tags, scan):
     """
-    For all non-file/image links, remove the referenced files from
-    the global list.
+    Record the web links in a file that another shard is checking, so that
+    the external links can be shared out between the shards. Nothing else
+    in the file is checked.
     """
-    links = soup.find_all('link')
-    for link in links:
-        file = link.get('href')
-        validate_link(filename, file, True)
-        validate_link(filename, f"{file}.gz", True)
-    # A trickier bit to check is the "picture" attribute which uses
-    # "source" and then a "data-srcset" tag. The "data-srcset" tag
-    # lists multiple images and needs to be parsed/split up into
-    # individual filenames for removal from the global list.
-    links = soup.find_all('source')
-    for link in links:
-        process_sources(link.get('data-srcset'))
-    # Script loading
-    links = soup.find_all('script')
-    for link in links:
-        validate_link(filename, link.get('src'), True)
-    # Forms
-    links = soup.find_all('form')
-    for link in links:
-        validate_link(filename, link.get('action'), True)
-    
-
-def process_sources(file_refs):
-    """ Check the source set off against the list of files """
-    if file_refs is None:
+    if args.noexternal:
+        return
+    if REDIRECT_RULES:
+        # Internal links can be redirected to other sites, which is only
+        # found out by validating them, so do that and keep just the links.
+        throwaway = new_file_scan(scan["file"])
+        validate_tags(scan["file"], tags, throwaway)
+        scan["links"].update(throwaway["links"])
         return
+    links = [
+        link.get('href') for link in tags['a']
+        if link.get('id') != "edit_on_github"
+    ]
+    links += [link.get('src') for link in tags['img']]
+    for text in links:
+        if text is not None and text.strip() != "":
+            web_link = as_web_link(text.strip())
+            if web_link is not None:
+                scan["links"][web_link] = None
+
+
+def validate_tags(filename, tags, scan):
+    """ Validate all of the links extracted from the file. """
+    for anchor in tags.get(ANCHOR_TAG, []):
+        scan["anchors"][anchor["id"]] = None
+    scan["parsed"] = True
+    check_links(filename, tags["a"], scan)
+    check_linked_images(filename, tags["img"], scan)
+    check_remaining_references(filename, tags, scan)
+
+
+class LinkExtractor(HTMLParser):
+    """
+    Streaming extractor built on the standard library's HTML tokenizer. Only
+    the start tags listed in LINK_ATTRIBUTES are recorded.
+    """
 
-    # A sample data-srcset:
-    # data-srcset="/../generated/assets/images/content/code_banner-576-65b154.webp 576w,
-    #  /../generated/assets/images/content/code_banner-768-65b154.webp 768w,
-    #  /../generated/assets/images/content/code_banner-992-65b154.webp 992w,
-    #  /../generated/assets/images/content/code_banner-1200-65b154.webp 1200w,
-    #  /../generated/assets/images/content/code_banner-1920-65b154.webp 1920w"
-    #
-    # So, start by splitting on the comma:
-    parts = file_refs.split(",")
-    # then iterate, splitting on the space:
-    removed_from_list = False
-    for part in parts:
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def handle_starttag(self, tag, attrs):
+        """ Record the attributes of interest for a wanted tag. """
+        wanted = LINK_ATTRIBUTES.get(tag)
+        if wanted is not None:
+            found = {}
+            for name, value in attrs:
+                if name in wanted:
+                    # BeautifulSoup reports an attribute without a value as
+                    # an empty string, so do the same.
+                    found[name] = "" if value is None else value
+            self.events.append((tag, found))
+        if COLLECT_ANCHORS:
+            self.events.extend(anchor_events(tag, attrs))
+
+
+class LxmlLinkTarget:
+    """ Parser target that records the wanted tags when lxml is used. """
+
+    def __init__(self):
+        self.events = []
+
+    def start(self, tag, attrib):
+        """ Record the attributes of interest for a wanted tag. """
+        wanted = LINK_ATTRIBUTES.get(tag)
+        if wanted is not None:
+            self.events.append(
+                (tag, {name: attrib[name] for name in wanted if name in attrib}))
+        if COLLECT_ANCHORS:
+            self.events.extend(anchor_events(tag, attrib.items()))
+
+    def end(self, tag):
+        """ Nothing to do at the end of a tag. """
+
+    def data(self, data):
+        """ Text is of no interest. """
+
+    def close(self):
+        """ Return the events once the document has been parsed. """
+        return self.events
+
+
+def extract_tags_stream(myfile):
+    """
+    Read the file in chunks through the standard library's tokenizer,
+    returning (tag, attributes) events in document order.
+    """
+    extractor = LinkExtractor()
+    for chunk in iter(lambda: myfile.read(65536), ""):
+        extractor.feed(chunk)
+    extractor.close()
+    return extractor.events
+
+
+def require_lxml():
+    """ Stop if lxml's parser has been asked for but isn't installed. """
+    if etree is None:
+        print("lxml is not installed; use a different --parser")
+        sys.exit(1)
+
+
+def extract_tags_lxml(myfile):
+    """ As extract_tags_stream but using lxml's (faster) HTML parser. """
+    require_lxml()
+    parser = etree.HTMLParser(target=LxmlLinkTarget())
+    for chunk in iter(lambda: myfile.read(65536), ""):
+        parser.feed(chunk)
+    return parser.close()
+
+
+def extract_tags_bs4(myfile):
+    """
+    Compatibility extractor that builds a full BeautifulSoup tree, as the
+    link checker used to do.
+    """
+    soup = BeautifulSoup(myfile.read(), 'html.parser')
+    events = []
+    for tag in soup.find_all(True if COLLECT_ANCHORS else list(LINK_ATTRIBUTES)):
+        wanted = LINK_ATTRIBUTES.get(tag.name)
+        if wanted is not None:
+            events.append(
+                (tag.name, {name: tag[name] for name in wanted if tag.has_attr(name)}))
+        if COLLECT_ANCHORS:
+            events.extend(anchor_events(tag.name, tag.attrs.items()))
+    return events
+
+
+def anchor_events(tag, attrs):
+    """
+    Return the events for any id on the tag, or name if it is an <a>,
+    since those are what a fragment can refer to.
+    """
+    return [
+        (ANCHOR_TAG, {"id": value}) for name, value in attrs
+        if value and (name == "id" or (name == "name" and tag == "a"))
+    ]
+
+
+EXTRACTORS = {
+    "stream": extract_tags_stream,
+    "lxml": extract_tags_lxml,
+    "bs4": extract_tags_bs4
+}
+
+
+class PageParser:
+    """
+    Parses a page that arrives in chunks with the --parser backend. The
+    stream and lxml backends never need the whole page at once; the page is
+    kept for BeautifulSoup, which does.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        if backend == "stream":
+            self.parser = LinkExtractor()
+        elif backend == "lxml":
+            require_lxml()
+            self.parser = etree.HTMLParser(target=LxmlLinkTarget())
+        else:
+            self.parser = io.StringIO()
+
+    def feed(self, chunk):
+        """ Parse the next part of the page. """
+        if self.backend == "bs4":
+            self.parser.write(chunk)
+        else:
+            self.parser.feed(chunk)
+
+    def close(self):
+        """ Return the (tag, attributes) events once the page has arrived. """
+        if self.backend == "stream":
+            self.parser.close()
+            return self.parser.events
+        if self.backend == "lxml":
+            return self.parser.close()
+        self.parser.seek(0)
+        return extract_tags_bs4(self.parser)
+
+
+def group_tags(events):
+    """
+    Group the extracted events by tag, keeping the attributes for each tag
+    in document order.
+    """
+    tags = {tag: [] for tag in LINK_ATTRIBUTES}
+    tags[ANCHOR_TAG] = []
+    for tag, attrs in events:
+        tags[tag].append(attrs)
+    return tags
+
+
+def init_worker(all_files, indexes, cli_args, verbose):
+    """
+    Set up the globals that checking a file relies on in a worker process.
+    """
+    global args # pylint: disable=global-statement,invalid-name
+    global VERBOSE # pylint: disable=global-statement
+    global COLLECT_ANCHORS # pylint: disable=global-statement
+    global REDIRECT_RULES # pylint: disable=global-statement
+    SITE.all_files = all_files
+    (SITE.file_index, SITE.dir_index, SITE.symlinked_dirs, SITE.sorted_files,
+     SITE.walk_order) = indexes
+    args = cli_args
+    COLLECT_ANCHORS = cli_args.check_anchors
+    VERBOSE = verbose
+    if cli_args.redirects is not None:
+        REDIRECT_RULES, _ = load_redirect_rules(cli_args.redirects)
+
+
+def check_file_worker(filename, skip_list):
+    """
+    Check a file in a worker process. Anything printed while checking the
+    file is captured and returned with the results so that the parent can
+    output it in the same order as a serial run would.
+    """
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    with contextlib.redirect_stdout(stdout), \
+            contextlib.redirect_stderr(stderr):
+        try:
+            scan = check_file(filename, skip_list)
+        except SystemExit as exception:
+            scan = new_file_scan(filename)
+            scan["exit"] = exception.code
+    scan["stdout"] = stdout.getvalue()
+    scan["stderr"] = stderr.getvalue()
+    return scan
+
+
+def merge_file_scan(scan):
+    """ Merge the results of checking a file into the globals. """
+    sys.stdout.write(scan["stdout"])
+    sys.stderr.write(scan["stderr"])
+    if scan["exit"] is not None:
+        sys.exit(scan["exit"])
+    if not scan["owned"]:
+        UNIQUE_LINKS.update(scan["links"])
+        return
+    record_failures(scan["failures"].values())
+    if scan["links"]:
+        record_links(scan["file"], scan["links"])
+        # ... only check the links once!
+        UNIQUE_LINKS.update(scan["links"])
+    SITE.referenced_files.update(scan["referenced"])
+    record_file_times(scan)
+    # Pages that were skipped or couldn't be read have no ids recorded, so
+    # fragments in links to them aren't checked.
+    if COLLECT_ANCHORS and scan["parsed"]:
+        SITE.anchors[page_key(scan["file"])] = scan["anchors"]
+        if scan["fragments"]:
+            SITE.fragment_links[scan["file"]] = scan["fragments"]
+
+
+def check_fragments():
+    """
+    Once every page has been checked, make sure that each fragment linked
+    to refers to an id on the target page. Pages that weren't checked
+    (because they aren't HTML or were skipped) have no ids recorded so
+    links to them are given the benefit of the doubt.
+    """
+    for file, fragments in SITE.fragment_links.items():
+        record_failures([
+            failure_record(
+                file, "%s#%s" % (page, fragment), "internal",
+                error="missing-anchor")
+            for page, fragment in fragments
+            if page in SITE.anchors and fragment not in SITE.anchors[page]
+        ])
+
+
+def add_fragment(scan, page, fragment):
+    """
+    Record a link to the fragment on page, if it is one worth checking.
+    An empty fragment or "top" always work.
+    """
+    fragment = unquote(fragment)
+    if COLLECT_ANCHORS and fragment not in ("", "top"):
+        scan["fragments"][(page_key(page), fragment)] = None
+
+
+def page_key(page):
+    """
+    Return the name that a page's ids are recorded under. A fetched page
+    can be linked to by its directory, which serves its index.html.
+    """
+    if page[-1:] == "/":
+        return page + "index.html"
+    return page
+
+
+def check_remaining_references(filename, tags, scan):
+    """
+    For all non-file/image links, remove the referenced files from
+    the global list.
+    """
+    for link in tags['link']:
+        file = link.get('href')
+        validate_link(filename, file, scan, True)
+        validate_link(filename, f"{file}.gz", scan, True)
+    # A trickier bit to check is the "picture" attribute which uses
+    # "source" and then a "data-srcset" tag. The "data-srcset" tag
+    # lists multiple images and needs to be parsed/split up into
+    # individual filenames for removal from the global list.
+    for link in tags['source']:
+        process_sources(link.get('data-srcset'), scan)
+    # Script loading
+    for link in tags['script']:
+        validate_link(filename, link.get('src'), scan, True)
+    # Forms
+    for link in tags['form']:
+        validate_link(filename, link.get('action'), scan, True)
+
+
+def process_sources(file_refs, scan):
+    """ Check the source set off against the list of files """
+    if file_refs is None:
+        return
+
+    # A sample data-srcset:
+    # data-srcset="/../generated/assets/images/content/code_banner-576-65b154.webp 576w,
+    #  /../generated/assets/images/content/code_banner-768-65b154.webp 768w,
+    #  /../generated/assets/images/content/code_banner-992-65b154.webp 992w,
+    #  /../generated/assets/images/content/code_banner-1200-65b154.webp 1200w,
+    #  /../generated/assets/images/content/code_banner-1920-65b154.webp 1920w"
+    #
+    # So, start by splitting on the comma:
+    parts = file_refs.split(",")
+    # then iterate, splitting on the space:
+    generated = []
+    for part in parts:
         file = part.strip().split(" ")[0]
         if file[:4] == "/../":
             # Trim "/." off the front so that we're left with "./" which will
             # then match against the filenames
             file = file[2:]
-            if reference_file(file):
-                removed_from_list = True
         elif file[0] == "/":
             file = "." + file
-            if reference_file(file):
-                removed_from_list = True
         else:
             print(f"Unable to parse '{file}'")
             print(f"Original was '{part}'")
             sys.exit(1)
-    # Finally, if we removed the generated assets from the list, try(!) to
-    # extract the filename of the original source image so that we can mark
-    # that as referenced.
+        add_target(scan, file)
+        generated.append(file)
+    orig = parts[0].strip().split(" ")[0]
+    # Strip off "/../generated" and then add a leading full-stop to
+    # match the full path to the original image.
+    orig = "." + orig[13:]
+    # Now split the string at the first hyphen which *should* split it at
+    # the size indicator.
+    orig_parts = orig.split("-")
+    to_match = orig_parts[0]
+    scan["prefixes"][to_match[2:]] = None
+    # Which original this finds depends on what earlier files have
+    # referenced, so it is only worked out once all of the files have been
+    # checked, by reference_sources.
+    scan["referenced"][(tuple(generated), to_match)] = None
+
+
+def reference_sources(generated, to_match):
+    """
+    Take the generated assets of a source set off the list and, if any of
+    them were still on it, try(!) to find the original source image so
+    that it can be marked as referenced too.
+    """
+    removed_from_list = False
+    for file in generated:
+        if reference_file(file):
+            removed_from_list = True
     if removed_from_list:
-        orig = parts[0].strip().split(" ")[0]
-        # Strip off "/../generated" and then add a leading full-stop to
-        # match the full path to the original image.
-        orig = "." + orig[13:]
-        # Now split the string at the first hyphen which *should* split it at
-        # the size indicator.
-        orig_parts = orig.split("-")
-        to_match = orig_parts[0]
-        matched = None
-        # and try to find the original
-        for unref in ALL_FILES:
-            if unref[:len(to_match)] == to_match:
-                matched = unref
-                break
+        matched = find_by_prefix(to_match)
         if matched is not None:
             reference_file(matched)
 
 
-def check_links(filename, soup, file_failed_links):
+def reference_scanned_files():
+    """
+    Take the files referenced by the checked files off the list. This is
+    done in the order that the references were found, once every file has
+    been checked, so that the original images found for source sets are
+    the same whatever order the files were checked in.
+    """
+    for reference in SITE.referenced_files:
+        # A source set is recorded as its generated assets and the prefix
+        # of its original.
+        if isinstance(reference, tuple):
+            reference_sources(*reference)
+        else:
+            reference_file(reference)
+
+
+def check_links(filename, a_links, scan):
     """ Check all links found in the file. """
-    a_links = soup.find_all('a')
-    # Linaro specific ... find any "edit on GitHub" links so that
-    # they can be EXCLUDED from the list of links to check. The reason
-    # why is because if this is a new page (i.e. in a Pull Request),
-    # the file won't exist in the repository yet and so the link to
-    # the page would fail.
-    gh_links = soup.find_all('a', id="edit_on_github")
-    for link in gh_links:
-        a_links.remove(link)
     for link in a_links:
-        result = validate_link(filename, link.get('href'))
+        # Linaro specific ... skip any "edit on GitHub" links. The reason
+        # why is because if this is a new page (i.e. in a Pull Request),
+        # the file won't exist in the repository yet and so the link to
+        # the page would fail.
+        if link.get('id') == "edit_on_github":
+            continue
+        result = validate_link(filename, link.get('href'), scan)
         if result is not None:
-            error = [filename, result]
-            if error not in file_failed_links:
-                file_failed_links.append(error)
+            add_failure(scan, failure_record(
+                filename, result, "internal", error="not-found"))
 
 
-def check_linked_images(filename, soup, file_failed_links):
+def check_linked_images(filename, img_links, scan):
     """ Check that all of the image links are valid. """
-    img_links = soup.find_all('img')
     for link in img_links:
-        result = validate_link(filename, link.get('src'))
+        result = validate_link(filename, link.get('src'), scan)
         if result is not None:
-            error = [filename, result]
-            if error not in file_failed_links:
-                file_failed_links.append(error)
+            add_failure(scan, failure_record(
+                filename, result, "internal", error="not-found"))
+
+
+def open_spill_store(directory):
+    """
+    Create the on-disk store for the file/link pairs and failed links. It
+    only has to last for this run so durability is traded for speed.
+    """
+    handle, spill_file = tempfile.mkstemp(
+        prefix="check-links-", suffix=".db", dir=directory)
+    os.close(handle)
+    store = sqlite3.connect(spill_file)
+    store.execute("PRAGMA journal_mode = OFF")
+    store.execute("PRAGMA synchronous = OFF")
+    store.execute("CREATE TABLE pairs (file TEXT NOT NULL, link TEXT NOT NULL)")
+    # name is the file as it is reported, which is what the report is
+    # sorted on.
+    store.execute(
+        "CREATE TABLE failures (file TEXT NOT NULL, url TEXT NOT NULL, "
+        "name TEXT NOT NULL, UNIQUE (file, url))")
+    return store, spill_file
+
+
+def close_spill_store(store, spill_file):
+    """ Close the on-disk store and remove it. """
+    store.close()
+    os.remove(spill_file)
+
+
+def record_links(file, links):
+    """ Record the web links found in a file. """
+    if SPILL_STORE is None:
+        SITE.file_link_pairs.setdefault(file, {}).update(links)
+    else:
+        SPILL_STORE.executemany(
+            "INSERT INTO pairs (file, link) VALUES (?, ?)",
+            ((file, link) for link in links))
+
+
+def file_link_pairs():
+    """ Yield each file and web link pair in the order they were found. """
+    if SPILL_STORE is None:
+        for file, links in SITE.file_link_pairs.items():
+            for link in links:
+                yield file, link
+    else:
+        yield from SPILL_STORE.execute(
+            "SELECT file, link FROM pairs ORDER BY rowid")
+
+
+def failure_record(source, target, kind, status=None, error=None):
+    """
+    Return the record of a failure. kind is internal, external or dir;
+    status is the HTTP status code, if there is one, and error says what
+    the problem is.
+    """
+    return {
+        "source": source,
+        "target": target,
+        "kind": kind,
+        "status": status,
+        "error": error
+    }
+
+
+def failure_key(failure):
+    """ Return the (file, link) that a failure is reported as. """
+    if failure["status"] is None:
+        return failure["source"], failure["target"]
+    return failure["source"], "%s [%d]" % (failure["target"], failure["status"])
+
+
+def add_failure(scan, failure):
+    """ Add a failure to the results for a file. """
+    scan["failures"][failure_key(failure)] = failure
+
+
+def record_failures(failures):
+    """
+    Record failed links, given as failure records, streaming any that
+    haven't been seen before to the report.
+    """
+    for failure in failures:
+        file, url = failure_key(failure)
+        if SPILL_STORE is None:
+            if (file, url) in SITE.failed_links:
+                continue
+            SITE.failed_links[(file, url)] = failure
+        else:
+            cursor = SPILL_STORE.execute(
+                "INSERT OR IGNORE INTO failures (file, url, name) "
+                "VALUES (?, ?, ?)",
+                (file, url, drop_dot(file)))
+            if cursor.rowcount == 0:
+                continue
+        stream_failure(failure)
+
+
+def stream_failure(failure, level="error"):
+    """ Write the failure to the report as it is found. """
+    if REPORT_STREAM is not None:
+        REPORT_STREAM.write(failure, level)
+
+
+class JsonLinesReport:
+    """ Writes each failure as a line of JSON. """
+
+    def __init__(self, output_to):
+        self.output_to = output_to
+
+    def write(self, failure, level):
+        """ Write out a failure. """
+        self.output_to.write(json.dumps(dict(failure, level=level)) + "\n")
+        self.output_to.flush()
+
+    def close(self):
+        """ Finish off the report. """
+
+
+class SarifReport:
+    """
+    Writes the failures as a SARIF log. The results are written out as they
+    are found, so the document is only complete once the run has finished.
+    """
+    RULES = {
+        "internal": "Links to files in the site must exist",
+        "external": "Links to other sites must be reachable",
+        "dir": "Directory names must not contain full-stops"
+    }
+
+    def __init__(self, output_to):
+        self.output_to = output_to
+        self.count = 0
+        driver = {
+            "name": "check_links_3",
+            "rules": [
+                {"id": kind, "shortDescription": {"text": text}}
+                for kind, text in self.RULES.items()
+            ]
+        }
+        header = json.dumps({
+            "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+            "version": "2.1.0",
+            "runs": [{"tool": {"driver": driver}, "results": []}]
+        })
+        # Leave the results array open for the failures to be added to.
+        self.output_to.write(header[:-len("]}]}")])
+
+    def write(self, failure, level):
+        """ Write out a failure. """
+        if failure["target"] is None:
+            text = "Invalid directory name"
+        elif failure["status"] is None:
+            text = "%s: %s" % (failure["error"], failure["target"])
+        else:
+            text = "%s [%d]: %s" % (
+                failure["error"], failure["status"], failure["target"])
+        # Fetched pages, and the sitemap or URL list, are already URLs.
+        uri = failure["source"]
+        if as_web_link(uri) is None:
+            uri = os.path.normpath(uri)
+        result = {
+            "ruleId": failure["kind"],
+            "level": level,
+            "message": {"text": text},
+            "locations": [{
+                "physicalLocation": {
+                    "artifactLocation": {
+                        "uri": uri
+                    }
+                }
+            }],
+            "properties": failure
+        }
+        if self.count:
+            self.output_to.write(",")
+        self.output_to.write(json.dumps(result))
+        self.output_to.flush()
+        self.count += 1
+
+    def close(self):
+        """ Finish off the report. """
+        self.output_to.write("]}]}\n")
+
+
+REPORT_FORMATS = {
+    "jsonl": JsonLinesReport,
+    "sarif": SarifReport
+}
+
+
+@contextlib.contextmanager
+def failure_stream():
+    """
+    Stream the failures to the output file while checking, if a machine
+    readable --format has been asked for.
+    """
+    global REPORT_STREAM # pylint: disable=global-statement
+    if args.format == "text":
+        yield
+        return
+    with open(args.output, "w") as output_to:
+        REPORT_STREAM = REPORT_FORMATS[args.format](output_to)
+        try:
+            yield
+        finally:
+            REPORT_STREAM.close()
+            REPORT_STREAM = None
+
+
+def failed_link_count():
+    """ Return how many failed links have been recorded. """
+    if SPILL_STORE is None:
+        return len(SITE.failed_links)
+    (count,) = SPILL_STORE.execute("SELECT COUNT(*) FROM failures").fetchone()
+    return count
+
+
+def failed_links_by_file():
+    """
+    Yield each file that has failed links along with its failed links,
+    sorted by file. With --low-memory this streams from the store, holding
+    only one file's failures at a time.
+    """
+    if SPILL_STORE is None:
+        failure_dict = failures_to_dict(SITE.failed_links)
+        for file in sorted(failure_dict):
+            yield file, failure_dict[file]
+        return
+    rows = SPILL_STORE.execute(
+        "SELECT name, url FROM failures ORDER BY name, rowid")
+    for file, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield file, [drop_dot(url) for _, url in group]
 
 
 def failures_to_dict(list_of_failures):
@@ -504,89 +2285,1048 @@ def failures_to_dict(list_of_failures):
 
 def scan_directory(path, skip_list, create_gh_issue, assign_gh_issue, gh_token):
     """ Scan the specified directory, ignoring anything that matches skip_list. """
-    global FAILED_LINKS # pylint: disable=global-statement
-    global FILE_LINK_PAIRS # pylint: disable=global-statement
     global UNIQUE_LINKS # pylint: disable=global-statement
-    FAILED_LINKS = []
-    FILE_LINK_PAIRS = []
-    UNIQUE_LINKS = []
+    global SPILL_STORE # pylint: disable=global-statement
+    SITE.failed_links = {}
+    SITE.file_link_pairs = {}
+    UNIQUE_LINKS = {}
+    SITE.referenced_files = {}
+    SITE.anchors.clear()
+    SITE.fragment_links.clear()
+    skip_list = skip_prefixes(skip_list)
+
+    if args.shard is not None:
+        scan_shard(path, skip_list)
+    elif args.low_memory:
+        SPILL_STORE, spill_file = open_spill_store(args.spill_dir)
+        try:
+            with failure_stream():
+                scan_tree(
+                    path, skip_list, create_gh_issue, assign_gh_issue, gh_token)
+        finally:
+            close_spill_store(SPILL_STORE, spill_file)
+            SPILL_STORE = None
+    else:
+        with failure_stream():
+            scan_tree(path, skip_list, create_gh_issue, assign_gh_issue, gh_token)
 
-    soft_failure = False
 
-    html_files = get_all_html_files(path)
-    total = len(html_files)
-    if args.file is not None:
-        total = len(args.file)
-    scan_html_files(html_files, skip_list, total)
+def scan_tree(path, skip_list, create_gh_issue, assign_gh_issue, gh_token):
+    """ Check the files in the tree, then report on what was found. """
+    soft_failure = False
+    check_site(path, skip_list)
     if len(UNIQUE_LINKS) == 0:
         print("No web links to check.")
     else:
-        soft_failure = scan_web_links()
-    if FAILED_LINKS != [] or FAILED_DIRS != []:
-        if create_gh_issue is None:
-            output_failed_links()
-        else:
-            github_create_issue(create_gh_issue, assign_gh_issue, gh_token)
+        with metrics_phase("external"):
+            soft_failure = scan_web_links()
+    if args.manifest is not None:
+        with metrics_phase("manifest"):
+            save_manifest(args.manifest)
+    report_results(soft_failure, create_gh_issue, assign_gh_issue, gh_token)
+
+
+def check_site(path, skip_list):
+    """
+    Check the files (or pages) of the site, leaving the web links that were
+    found in UNIQUE_LINKS to be checked.
+    """
+    if scanning_urls():
+        with metrics_phase("scan"):
+            run_async(scan_pages(skip_list))
+    else:
+        with metrics_phase("walk"):
+            html_files = get_all_html_files(path)
+        total = len(html_files)
+        if args.file is not None:
+            total = len(args.file)
+        with metrics_phase("scan"):
+            scan_html_files(html_files, skip_list, total)
+    if COLLECT_ANCHORS:
+        with metrics_phase("anchors"):
+            check_fragments()
+    # Only now that every file has been checked can the referenced files
+    # be taken off the list, so that the order the files were checked in
+    # makes no difference to the results.
+    reference_scanned_files()
+
+
+def report_results(soft_failure, create_gh_issue, assign_gh_issue, gh_token):
+    """ Report the failures, either as output or as a GitHub issue. """
+    with metrics_phase("report"):
+        if failed_link_count() or SITE.failed_dirs:
+            if create_gh_issue is None:
+                output_failed_links()
+            else:
+                github_create_issue(create_gh_issue, assign_gh_issue, gh_token)
     if soft_failure:
         print("\nLinks have been checked; warnings reported.")
     else:
         print("\nLinks have been successfully checked.")
 
 
+def batch_paths(path, directories):
+    """
+    Return the file that each site's copy of path is written to with --batch:
+    path with the name of the site's directory added, and the site's position
+    in the batch as well if more than one site has that name.
+    """
+    if path is None:
+        return [None] * len(directories)
+    root, ext = os.path.splitext(os.path.abspath(path))
+    names = [os.path.basename(directory) for directory in directories]
+    paths = []
+    for position, name in enumerate(names, 1):
+        if names.count(name) > 1:
+            name = "%s-%s" % (name, position)
+        paths.append("%s-%s%s" % (root, name, ext))
+    return paths
+
+
+def scan_batch(directories, skip_list):
+    """
+    Check several sites in one run. The files of each site are checked in
+    turn, then the web links of all of them are checked together, so a link
+    that appears on more than one site is only requested once, and finally
+    each site is reported on separately.
+    """
+    global SITE # pylint: disable=global-statement
+    global OUTPUT_FILE # pylint: disable=global-statement
+    skip_list = skip_prefixes(skip_list)
+    # Worked out before changing into any of the sites.
+    outputs = batch_paths(args.output, directories)
+    unreferenced_jsons = batch_paths(args.unreferenced_json, directories)
+    sites = []
+    site_links = 0
+    for directory in directories:
+        print("Scanning '%s'" % directory)
+        os.chdir(directory)
+        SITE = Site()
+        # The site's own web links are kept to one side while the union of
+        # them is built up in UNIQUE_LINKS.
+        all_links = UNIQUE_LINKS.copy()
+        UNIQUE_LINKS.clear()
+        check_site("./", skip_list)
+        site_links += len(UNIQUE_LINKS)
+        UNIQUE_LINKS.update(all_links)
+        sites.append(SITE)
+    if len(UNIQUE_LINKS) == 0:
+        print("No web links to check.")
+    else:
+        print("%s sites share %s of their %s web links" % (
+            len(sites), site_links - len(UNIQUE_LINKS), site_links))
+        count_metric("batch_requests_saved", site_links - len(UNIQUE_LINKS))
+        with metrics_phase("external"):
+            run_async(check_unique_links())
+    for directory, site, output, unreferenced_json in zip(
+            directories, sites, outputs, unreferenced_jsons):
+        print("\nResults for '%s'" % directory)
+        os.chdir(directory)
+        SITE = site
+        args.output, args.unreferenced_json = output, unreferenced_json
+        if args.format == "text":
+            OUTPUT_FILE = output
+        # The failures can only be written out once the output file for
+        # this site is open.
+        with failure_stream():
+            for path in SITE.failed_dirs:
+                stream_failure(failure_record(path, None, "dir", error="invalid-name"))
+            for failure in SITE.failed_links.values():
+                stream_failure(failure)
+            soft_failure = report_web_failures(web_link_failures())
+            report_results(soft_failure, None, None, None)
+        report_unreferenced()
+
+
+def report_unreferenced():
+    """ List the files that nothing links to, and how much space they use. """
+    # Before we produce a list of unreferenced files, mark the obvious files
+    # as referenced ... this is a bit hacky there 
+    for file in PROTECTED_FILES:
+        reference_file(file)
+
+    with metrics_phase("unreferenced"):
+        summary = unreferenced_summary()
+        if len(SITE.all_files) == 0:
+            print("All files are referenced.")
+        else:
+            print("The following files do not appear to be referenced:")
+            for unref in SITE.all_files:
+                print(unref)
+            size = summary["bytes"]
+            print(f"Possible size to reclaim: {size/1024**2}MB")
+            report_largest("directory", summary["by_directory"])
+            report_largest("extension", summary["by_extension"])
+            print("\nLargest unreferenced files:")
+            for unref in summary["largest"]:
+                print("%10.2fMB  %s" % (unref["bytes"] / 1024**2, unref["file"]))
+        count_metric("unreferenced_files", len(SITE.all_files))
+        count_metric("unreferenced_bytes", summary["bytes"])
+        if args.unreferenced_json is not None:
+            with open(args.unreferenced_json, "w") as json_file:
+                json.dump(summary, json_file, indent=2)
+
+
+def unreferenced_summary():
+    """
+    Total up the space used by the unreferenced files, overall and for each
+    directory and extension, along with the largest files.
+    """
+    by_directory = {}
+    by_extension = {}
+    total = 0
+    for unref in SITE.all_files:
+        size = SITE.file_sizes.get(unref, 0)
+        total += size
+        extension = os.path.splitext(unref)[1].lower() or "(none)"
+        for key, rollup in ((os.path.dirname(unref), by_directory),
+                            (extension, by_extension)):
+            entry = rollup.setdefault(key, {"files": 0, "bytes": 0})
+            entry["files"] += 1
+            entry["bytes"] += size
+    largest = heapq.nlargest(
+        UNREFERENCED_TOP, SITE.all_files, key=lambda unref: SITE.file_sizes.get(unref, 0))
+    return {
+        "files": len(SITE.all_files),
+        "bytes": total,
+        "unreferenced": [
+            {"file": unref, "bytes": SITE.file_sizes.get(unref, 0)} for unref in SITE.all_files
+        ],
+        "by_directory": by_directory,
+        "by_extension": by_extension,
+        "largest": [
+            {"file": unref, "bytes": SITE.file_sizes.get(unref, 0)} for unref in largest
+        ]
+    }
+
+
+def report_largest(kind, rollup):
+    """ Print the entries of the rollup that use the most space. """
+    print("\nUnreferenced files by %s:" % kind)
+    largest = heapq.nlargest(
+        UNREFERENCED_TOP, rollup.items(), key=lambda item: item[1]["bytes"])
+    for key, entry in largest:
+        print("%10.2fMB %6s files  %s" % (
+            entry["bytes"] / 1024**2, entry["files"], key))
+
+
+def scanning_urls():
+    """ Return whether pages are being fetched rather than read from disk. """
+    return args.sitemap is not None or args.url_list is not None
+
+
+async def read_source(session, source):
+    """ Read a sitemap or URL list, which can be a local file or a URL. """
+    if as_web_link(source) is not None:
+        async with session.get(source, headers=CHROME) as response:
+            response.raise_for_status()
+            data = await response.read()
+    else:
+        with open(source, "rb") as myfile:
+            data = myfile.read()
+    if source.endswith(".gz"):
+        data = gzip.decompress(data)
+    return data
+
+
+async def sitemap_urls(session, source, depth=0):
+    """
+    Return the page URLs in the sitemap, following any sitemap index to
+    the sitemaps that it lists.
+    """
+    urls = []
+    nested = []
+    data = io.BytesIO(await read_source(session, source))
+    for _, element in xml.etree.ElementTree.iterparse(data):
+        # Ignore the namespace
+        tag = element.tag.rpartition("}")[2]
+        if tag == "loc" and element.text:
+            urls.append(element.text.strip())
+        elif tag == "sitemap":
+            nested.extend(urls[-1:])
+            del urls[-1:]
+        element.clear()
+    for sitemap in nested:
+        if depth >= MAX_SITEMAP_DEPTH:
+            print("Sitemaps nested too deeply at %s" % sitemap)
+            break
+        urls.extend(await sitemap_urls(session, sitemap, depth + 1))
+    return urls
+
+
+async def page_urls(session):
+    """ Return the URLs of the pages to check, without any duplicates. """
+    if args.sitemap is not None:
+        urls = await sitemap_urls(session, args.sitemap)
+    else:
+        data = await read_source(session, args.url_list)
+        urls = [
+            line.strip() for line in data.decode("utf-8").splitlines()
+            if line.strip() != "" and not line.strip().startswith("#")
+        ]
+    return list(dict.fromkeys(urls))
+
+
+def page_decoder(charset):
+    """
+    Return an incremental decoder for the page's charset, using UTF-8 if it
+    doesn't have one or it isn't one that Python knows.
+    """
+    try:
+        return codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+async def fetch_page(session, url, skip_list, slots):
+    """
+    Fetch the page and check the links in it as it arrives. Returns the
+    results for the page.
+    """
+    scan = new_file_scan(url)
+    if matched_skip("." + urlsplit(url).path, skip_list):
+        return scan
+    async with slots:
+        try:
+            async with session.get(
+                    url, allow_redirects=True, headers=CHROME) as response:
+                if response.status == 404 or response.status == 405:
+                    FETCHED_PAGES[url] = response.status
+                    add_failure(scan, failure_record(
+                        args.sitemap or args.url_list, url, "external",
+                        response.status, "http"))
+                    return scan
+                FETCHED_PAGES[url] = 0
+                if response.status >= 400 or "html" not in response.content_type:
+                    return scan
+                parser = PageParser(args.parser)
+                decoder = page_decoder(response.charset)
+                async for chunk in response.content.iter_chunked(PAGE_CHUNK):
+                    start = time.perf_counter()
+                    parser.feed(decoder.decode(chunk))
+                    scan["parse_seconds"] += time.perf_counter() - start
+                start = time.perf_counter()
+                parser.feed(decoder.decode(b"", final=True))
+                tags = group_tags(parser.close())
+                scan["parse_seconds"] += time.perf_counter() - start
+                # Relative links are relative to where any redirects ended
+                # up, or to the page's <base> if it has one.
+                scan["base"] = str(response.url)
+                for base in tags.get("base", []):
+                    if base.get("href"):
+                        scan["base"] = urljoin(scan["base"], base["href"])
+                        break
+        # Any other problem with the request or the response is only a
+        # problem for this page, so it mustn't stop the rest being checked.
+        except ERRORS_HANDLED + (aiohttp.ClientError, ValueError) as exception:
+            print("Error while fetching %s: %s" % (url, exception))
+            return scan
+    start = time.perf_counter()
+    validate_tags(url, tags, scan)
+    scan["validate_seconds"] = time.perf_counter() - start
+    return scan
+
+
+async def scan_pages(skip_list):
+    """
+    Fetch the pages in the sitemap or URL list and check them. The pages
+    are fetched concurrently, in as many at once as --max-in-flight-bytes
+    allows, and their results are merged in the order they are listed.
+    """
+    async with open_session() as session:
+        urls = await page_urls(session)
+        print("Found %s pages to check" % len(urls))
+        slots = asyncio.Semaphore(max(1, args.max_in_flight_bytes // PAGE_BUFFER))
+        tasks = [
+            asyncio.ensure_future(fetch_page(session, url, skip_list, slots))
+            for url in urls
+        ]
+        count = 1
+        for task in tasks:
+            print("(%s/%s) Checking '%s'" % (count, len(urls), urls[count - 1]))
+            merge_file_scan(await task)
+            count += 1
+
+
 def scan_html_files(html_files, skip_list, total):
     """ Scan each of the specified HTML files. """
-    global FAILED_LINKS # pylint: disable=global-statement
+    if args.file is not None:
+        wanted = set(args.file)
+    to_check = [
+        this_file for this_file in html_files
+        if args.file is None or this_file in wanted
+    ]
+    reused = {}
+    if keeping_manifest():
+        reused = reusable_scans(to_check, skip_list)
+    fresh = [this_file for this_file in to_check if this_file not in reused]
+    if JOBS > 1 and len(fresh) > 1:
+        results = scan_html_files_parallel(fresh, skip_list)
+    else:
+        results = (check_file(this_file, skip_list) for this_file in fresh)
     count = 1
-    for this_file in html_files:
-        if args.file is None or this_file in args.file:
+    for this_file in to_check:
+        if this_file in reused:
+            print("(%s/%s) Unchanged '%s'" % (count, total, this_file))
+            scan = reused[this_file]
+        elif not in_shard(this_file):
+            merge_file_scan(next(results))
+            continue
+        else:
             print("(%s/%s) Checking '%s'" % (count, total, this_file))
-            count += 1
-            results = check_file(this_file, skip_list)
-            for res in results:
-                if res not in FAILED_LINKS:
-                    FAILED_LINKS.append(res)
+            scan = next(results)
+        count += 1
+        merge_file_scan(scan)
+        if keeping_manifest():
+            record_manifest_scan(scan)
 
 
-def scan_web_links():
-    """ Scan all of the discovered external links. """
-    global FAILED_LINKS # pylint: disable=global-statement
-    soft_failure = False
+def keeping_manifest():
+    """
+    Return whether the results for each file are being kept so that a
+    later check can reuse them, either from the manifest or, with --watch,
+    in memory.
+    """
+    return args.manifest is not None or args.watch
+
+
+def scan_html_files_parallel(to_check, skip_list):
+    """
+    Check the HTML files in a pool of worker processes, yielding the results
+    in the same order that a serial scan would produce them.
+    """
+    # Hand the files out in reasonably sized chunks to keep the IPC
+    # overhead down without leaving workers idle at the end.
+    chunksize = max(1, len(to_check) // (JOBS * 16))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=JOBS,
+            initializer=init_worker,
+            initargs=(
+                SITE.all_files,
+                (SITE.file_index, SITE.dir_index, SITE.symlinked_dirs, SITE.sorted_files,
+                 SITE.walk_order),
+                args,
+                VERBOSE)) as executor:
+        yield from executor.map(
+            check_file_worker,
+            to_check,
+            [skip_list] * len(to_check),
+            chunksize=chunksize)
+
+
+def open_manifest(manifest_file, mode, path=None):
+    """
+    Open the manifest, which is compressed if its name ends in .gz. If path
+    is given, that is opened instead but still named after manifest_file.
+    """
+    if manifest_file.endswith(".gz"):
+        return gzip.open(path or manifest_file, mode, compresslevel=6)
+    return open(path or manifest_file, mode)
+
+
+def load_manifest(manifest_file):
+    """
+    Load the manifest written by the previous run. Returns None if there
+    isn't a usable one, in which case every file gets checked.
+    """
+    if not os.path.isfile(manifest_file):
+        return None
+    try:
+        with open_manifest(manifest_file, "rt") as myfile:
+            manifest = json.load(myfile)
+    except (OSError, ValueError):
+        print("Couldn't load manifest from %s" % manifest_file)
+        return None
+    # The stored tags only include the anchors if they were being checked,
+    # and the stored results only include the kinds of link that were.
+    if (manifest.get("version") != MANIFEST_VERSION or
+            manifest.get("check_anchors") != COLLECT_ANCHORS or
+            manifest.get("noexternal") != args.noexternal or
+            manifest.get("nointernal") != args.nointernal or
+            manifest.get("redirects") != REDIRECT_RULES_HASH):
+        return None
+    return manifest
+
+
+def file_hash(filename):
+    """ Return a hash of the file's contents. """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as myfile:
+        for chunk in iter(lambda: myfile.read(1024**2), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reusable_scans(to_check, skip_list):
+    """
+    Work out which files have the same contents as in the previous run.
+    Their results are reused unless a path that they link to has been
+    added or removed since, in which case their links are validated again
+    from the tags stored in the manifest rather than parsing the file.
+    Returns the results for each of the files that don't need checking.
+    """
+    reused = {}
+    if MANIFEST is None:
+        return reused
+    changed = set(MANIFEST["file_index"]).symmetric_difference(SITE.file_index)
+    changed.update(set(MANIFEST["dir_index"]).symmetric_difference(SITE.dir_index))
+    for this_file in to_check:
+        count_metric("manifest_files_lookups")
+        entry = MANIFEST["files"].get(this_file)
+        # With --watch, a file that hasn't changed is known to still match.
+        if (entry is None or matched_skip(this_file, skip_list) or
+                (path_changed(this_file) and
+                 entry["hash"] != file_hash(this_file))):
+            continue
+        prefixes = tuple(entry["prefixes"])
+        if (changed.isdisjoint(entry["targets"]) and
+                not (prefixes and any(
+                    path.startswith(prefixes) for path in changed))):
+            scan = scan_from_manifest(this_file, entry)
+            count_metric("manifest_files_reused")
+        else:
+            scan = new_file_scan(this_file)
+            scan["tags"] = entry["tags"]
+            start = time.perf_counter()
+            validate_tags(this_file, entry["tags"], scan)
+            scan["validate_seconds"] = time.perf_counter() - start
+            count_metric("manifest_files_revalidated")
+        scan["hash"] = entry["hash"]
+        reused[this_file] = scan
+    return reused
+
+
+def scan_from_manifest(filename, entry):
+    """ Rebuild a file's results from its manifest entry. """
+    scan = new_file_scan(filename)
+    scan["failures"] = {
+        failure_key(failure): failure for failure in entry["failures"]
+    }
+    for key in ("links", "targets", "prefixes", "anchors"):
+        scan[key] = dict.fromkeys(entry[key])
+    # The source sets come back from JSON as lists.
+    scan["referenced"] = {
+        (tuple(reference[0]), reference[1]) if isinstance(reference, list)
+        else reference: None
+        for reference in entry["referenced"]
+    }
+    scan["fragments"] = {tuple(fragment): None for fragment in entry["fragments"]}
+    scan["tags"] = entry["tags"]
+    scan["parsed"] = True
+    return scan
+
+
+def record_manifest_scan(scan):
+    """
+    Keep the results for the file for the next manifest. Results that
+    can't be reproduced from the manifest aren't kept so that the file is
+    checked again next time.
+    """
+    if (scan["tags"] is None or scan["volatile"] or scan["stdout"] != "" or
+            scan["stderr"] != "" or scan["exit"] is not None):
+        return
+    MANIFEST_FILES[scan["file"]] = {
+        "hash": scan["hash"] or file_hash(scan["file"]),
+        "failures": list(scan["failures"].values()),
+        "links": list(scan["links"]),
+        "referenced": list(scan["referenced"]),
+        "targets": list(scan["targets"]),
+        "prefixes": list(scan["prefixes"]),
+        "anchors": list(scan["anchors"]),
+        "fragments": [list(fragment) for fragment in scan["fragments"]],
+        "tags": scan["tags"]
+    }
+
+
+def save_manifest(manifest_file):
+    """ Write the manifest for the next run. """
+    manifest = build_manifest()
+    temp_file = manifest_file + ".tmp"
+    with open_manifest(manifest_file, "wt", temp_file) as myfile:
+        # json.dumps uses the C encoder, which json.dump doesn't.
+        myfile.write(json.dumps(manifest, separators=(",", ":")))
+    os.replace(temp_file, manifest_file)
+
+
+def build_manifest():
+    """
+    Return the manifest for the next run. Files that weren't checked this
+    time (because of --file) keep their previous entries, as do the results
+    for external links that weren't checked.
+    """
+    files = {}
+    external = {}
+    if MANIFEST is not None:
+        files = {
+            file: entry for file, entry in MANIFEST["files"].items()
+            if os.path.normpath(file) in SITE.file_index
+        }
+        external = {
+            link: result for link, result in MANIFEST["external"].items()
+            if link in UNIQUE_LINKS
+        }
+    files.update(MANIFEST_FILES)
+    external.update(LINK_RESULTS)
+    return {
+        "version": MANIFEST_VERSION,
+        "check_anchors": COLLECT_ANCHORS,
+        "noexternal": args.noexternal,
+        "nointernal": args.nointernal,
+        "redirects": REDIRECT_RULES_HASH,
+        "file_index": list(SITE.file_index),
+        "dir_index": list(SITE.dir_index),
+        "files": files,
+        "external": external
+    }
+
+
+def watch_directory(path, skip_list):
+    """
+    Keep checking the site as it is rebuilt, printing the failures that
+    have appeared or been fixed each time. The results of the previous
+    check are used as the manifest for the next one, so only the pages
+    that have changed, and those linking to paths that have appeared or
+    disappeared, are checked again.
+    """
+    skip_list = skip_prefixes(skip_list)
+    failures = current_failures()
+    try:
+        watcher = InotifyWatcher()
+    except (OSError, AttributeError):
+        watcher = PollingWatcher(path)
+    print("\nWatching '%s' for changes; press Ctrl-C to stop" % os.getcwd())
+    try:
+        while True:
+            try:
+                changed = watcher.wait(SITE.dir_index)
+            except OSError as exception:
+                # For example, a big site can use up the inotify watches.
+                print("Can't watch for changes with inotify (%s); looking "
+                      "for them every %s seconds instead" % (
+                          exception, WATCH_INTERVAL))
+                watcher.close()
+                watcher = PollingWatcher(path)
+                continue
+            start = time.perf_counter()
+            counters = METRICS["counters"].copy()
+            latest = recheck_site(path, skip_list, changed)
+            report_changes(
+                failures, latest, counters, time.perf_counter() - start)
+            failures = latest
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+    finally:
+        watcher.close()
+
+
+def recheck_site(path, skip_list, changed):
+    """
+    Check the site again, reusing the results of the previous check, and
+    return the failures that were found. Only the changed paths are read
+    again unless changed is None.
+    """
+    global SITE # pylint: disable=global-statement
+    global PREVIOUS_SITE, CHANGED_PATHS # pylint: disable=global-statement
+    global MANIFEST # pylint: disable=global-statement
+    global DEADLINE # pylint: disable=global-statement
+    MANIFEST = build_manifest()
+    MANIFEST_FILES.clear()
+    if changed is not None:
+        PREVIOUS_SITE = SITE
+    CHANGED_PATHS = changed
+    SITE = Site()
+    UNIQUE_LINKS.clear()
+    UNCHECKED_LINKS.clear()
+    if args.deadline is not None:
+        DEADLINE = time.monotonic() + args.deadline
+    # Only the changes get printed, not the progress of the check.
+    with contextlib.redirect_stdout(io.StringIO()):
+        check_site(path, skip_list)
+        PREVIOUS_SITE = None
+        if UNIQUE_LINKS:
+            run_async(check_unique_links())
+    return current_failures()
+
+
+def current_failures():
+    """ Return all of the failures from the last check, keyed by failure_key. """
+    failures = {}
+    for path in SITE.failed_dirs:
+        failure = failure_record(path, None, "dir", error="invalid-name")
+        failures[failure_key(failure)] = failure
+    failures.update(SITE.failed_links)
+    failures.update(web_link_failures())
+    return failures
+
+
+def report_changes(before, after, counters, elapsed):
+    """
+    Print how much of the site had to be checked again and the failures
+    that have appeared (+) or been fixed (-) since the previous check.
+    """
+    def counted(name):
+        return METRICS["counters"][name] - counters[name]
+
+    revalidated = counted("manifest_files_revalidated")
+    parsed = (counted("manifest_files_lookups") - revalidated -
+              counted("manifest_files_reused"))
+    added = [key for key in after if key not in before]
+    fixed = [key for key in before if key not in after]
+    print("\nChecked the site again in %.2fs: %s pages parsed, %s revalidated; "
+          "%s new failures, %s fixed" % (
+              elapsed, parsed, revalidated, len(added), len(fixed)))
+    for mark, keys in (("+", added), ("-", fixed)):
+        for file, url in keys:
+            if url is None:
+                print("%s %s (directory with a full-stop in its name)" % (
+                    mark, drop_dot(file)))
+            else:
+                print("%s %s: %s" % (mark, drop_dot(file), drop_dot(url)))
+
+
+class InotifyWatcher:
+    """
+    Waits for the site to change using Linux's inotify, through ctypes so
+    that nothing else needs to be installed.
+    """
+    # IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE,
+    # IN_DELETE_SELF and IN_MOVE_SELF
+    MASK = 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+    # IN_DELETE_SELF and IN_MOVE_SELF are about the watched directory itself,
+    # IN_IGNORED says that a watch has gone and IN_Q_OVERFLOW that events
+    # have been lost.
+    SELF = 0x400 | 0x800
+    IGNORED = 0x8000
+    OVERFLOW = 0x4000
+    # struct inotify_event, which is followed by the name.
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.inotify < 0:
+            raise OSError(ctypes.get_errno(), "inotify isn't available")
+        # watch descriptor -> the directory it watches
+        self.watched = {}
+
+    def wait(self, directories):
+        """
+        Wait until something in the directories changes and then, since a
+        rebuild writes lots of files, until the changes stop. Returns the
+        paths that changed, or None if some of the changes were missed.
+        """
+        # Adding a watch again just replaces it, so new directories are
+        # picked up by watching all of them each time.
+        for directory in directories:
+            watch = self.libc.inotify_add_watch(
+                self.inotify, os.fsencode(directory), self.MASK)
+            if watch < 0:
+                error = ctypes.get_errno()
+                # The directory has gone since the site was last checked.
+                if error != errno.ENOENT:
+                    raise OSError(error, os.strerror(error), directory)
+                continue
+            self.watched[watch] = directory
+        changed = set()
+        complete = True
+        select.select([self.inotify], [], [])
+        while select.select([self.inotify], [], [], WATCH_SETTLE)[0]:
+            events = os.read(self.inotify, 65536)
+            offset = 0
+            while offset < len(events):
+                watch, mask, _, length = self.EVENT.unpack_from(events, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(events[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & self.OVERFLOW or watch not in self.watched:
+                    complete = False
+                elif mask & self.IGNORED:
+                    del self.watched[watch]
+                elif mask & self.SELF:
+                    changed.add(self.watched[watch])
+                else:
+                    changed.add(os.path.normpath(join(self.watched[watch], name)))
+        return changed if complete else None
+
+    def close(self):
+        """ Stop watching. """
+        os.close(self.inotify)
+
+
+class PollingWatcher:
+    """
+    Waits for the site to change by looking at the size and modification
+    time of every file each WATCH_INTERVAL seconds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        """
+        Return the size and modification time of each file, along with the
+        directories so that those appearing or going are noticed.
+        """
+        snapshot = {}
+        for root, dirs, files in os.walk(self.path):
+            for name in dirs:
+                snapshot[join(root, name)] = None
+            for name in files:
+                try:
+                    stat = os.lstat(join(root, name))
+                except OSError:
+                    continue
+                snapshot[join(root, name)] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, _directories):
+        """
+        Wait until the site changes and then stops changing. Returns the
+        paths that changed.
+        """
+        snapshot = self.snapshot
+        while snapshot == self.snapshot:
+            time.sleep(WATCH_INTERVAL)
+            snapshot = self.take_snapshot()
+        while True:
+            time.sleep(WATCH_SETTLE)
+            latest = self.take_snapshot()
+            if latest == snapshot:
+                break
+            snapshot = latest
+        changed = {
+            os.path.normpath(path)
+            for path in set(snapshot).symmetric_difference(self.snapshot)
+        }
+        changed.update(
+            os.path.normpath(path) for path, stat in snapshot.items()
+            if path in self.snapshot and stat != self.snapshot[path])
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        """ Stop watching. """
+
+
+def positive_int(text):
+    """ Parse an argument that has to be a whole number of at least 1. """
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a whole number") from None
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
+
+
+def shard_spec(text):
+    """ Parse the argument to --shard, which is given as i/N. """
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be given as i/N") from None
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("i must be between 1 and N")
+    return index, count
+
+
+def in_shard(key):
+    """
+    Return whether this shard is responsible for the file or web link. The
+    hash has to be the same in every process, so hash() can't be used.
+    """
+    if args.shard is None:
+        return True
+    index, count = args.shard
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index - 1
+
+
+def scan_shard(path, skip_list):
+    """
+    Check this shard's HTML files and web links, then write out the partial
+    results for --merge to combine. Every shard still reads all of the HTML
+    files to find the web links, which are shared out separately from the
+    files so that each one is only checked once.
+    """
+    with metrics_phase("walk"):
+        html_files = get_all_html_files(path)
+    if args.file is not None:
+        html_files = [file for file in html_files if file in args.file]
+    total = len([file for file in html_files if in_shard(file)])
+    with metrics_phase("scan"):
+        scan_html_files(html_files, skip_list, total)
+    reference_scanned_files()
+    if UNIQUE_LINKS:
+        with metrics_phase("external"):
+            run_async(check_unique_links())
+    save_shard(args.shard_out)
+    print("\nResults for shard %s/%s written to %s" % (
+        args.shard[0], args.shard[1], args.shard_out))
+
+
+def save_shard(shard_file):
+    """ Write out the partial results of this shard. """
+    shard = {
+        "version": SHARD_VERSION,
+        "shard": list(args.shard),
+        "failed_dirs": list(SITE.failed_dirs),
+        "failures": list(SITE.failed_links.values()),
+        # Each shard has only taken off the files that its own files
+        # reference; anything still here in every shard is unreferenced.
+        "unreferenced": {file: SITE.file_sizes.get(file, 0) for file in SITE.all_files},
+        "file_link_pairs": {
+            file: list(links) for file, links in SITE.file_link_pairs.items()
+        },
+        "link_results": LINK_RESULTS,
+        "unchecked": list(UNCHECKED_LINKS)
+    }
+    if COLLECT_ANCHORS:
+        shard["anchors"] = {page: list(ids) for page, ids in SITE.anchors.items()}
+        shard["fragment_links"] = {
+            file: list(fragments) for file, fragments in SITE.fragment_links.items()
+        }
+    temp_file = shard_file + ".tmp"
+    with open_manifest(shard_file, "wt", temp_file) as myfile:
+        myfile.write(json.dumps(shard, separators=(",", ":")))
+    os.replace(temp_file, shard_file)
+
+
+def load_shards(shard_files):
+    """
+    Load the partial results written by the shards, making sure that there
+    is exactly one of each.
+    """
+    shards = []
+    for shard_file in shard_files:
+        with open_manifest(shard_file, "rt") as myfile:
+            shard = json.load(myfile)
+        if shard.get("version") != SHARD_VERSION:
+            print("%s wasn't written by this version of the link checker" %
+                  shard_file)
+            sys.exit(1)
+        shards.append(shard)
+    shards.sort(key=lambda shard: shard["shard"][0])
+    count = shards[0]["shard"][1]
+    if [shard["shard"] for shard in shards] != [
+            [index, count] for index in range(1, count + 1)]:
+        print("Expected one result file for each of the %s shards" % count)
+        sys.exit(1)
+    return shards
+
+
+def merge_shards(shard_files, create_gh_issue, assign_gh_issue, gh_token):
+    """
+    Combine the partial results from the shards and report on them as a
+    single run would.
+    """
+    shards = load_shards(shard_files)
+    for path in shards[0]["failed_dirs"]:
+        record_failed_dir(path)
+    # The first shard's files are in the order that the walk found them.
+    SITE.all_files = {
+        file: None for file in shards[0]["unreferenced"]
+        if all(file in shard["unreferenced"] for shard in shards[1:])
+    }
+    SITE.file_sizes.update(shards[0]["unreferenced"])
+    for shard in shards:
+        record_failures(shard["failures"])
+        for file, links in shard["file_link_pairs"].items():
+            record_links(file, dict.fromkeys(links))
+            UNIQUE_LINKS.update(dict.fromkeys(links))
+        for link, result in shard["link_results"].items():
+            record_link_result(link, result)
+        UNCHECKED_LINKS.update(dict.fromkeys(shard.get("unchecked", [])))
+        for page, ids in shard.get("anchors", {}).items():
+            SITE.anchors[page] = dict.fromkeys(ids)
+        for file, fragments in shard.get("fragment_links", {}).items():
+            SITE.fragment_links[file] = dict.fromkeys(
+                tuple(fragment) for fragment in fragments)
+    print("Merged the results of %s shards" % len(shards))
+    if SITE.anchors:
+        with metrics_phase("anchors"):
+            check_fragments()
+    soft_failure = report_web_failures(web_link_failures())
+    report_results(soft_failure, create_gh_issue, assign_gh_issue, gh_token)
+
+
+def run_async(coroutine):
+    """ Run the coroutine in a new event loop and return its result. """
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    cul_result = loop.run_until_complete(check_unique_links())
+    result = loop.run_until_complete(coroutine)
     loop.close()
+    return result
+
+
+def scan_web_links():
+    """ Scan all of the discovered external links. """
+    return report_web_failures(run_async(check_unique_links()))
+
+
+def report_web_failures(cul_result):
+    """
+    Record the failed web links, or just warn about them if they aren't
+    being treated as errors. Returns True if there were warnings.
+    """
+    soft_failure = False
     # If we are NOT reporting broken external links as an error,
     # report them as warnings if there are any.
     if args.no_external_errors:
-        if cul_result != []:
+        if cul_result:
             print("\n\nWARNING! %s failed external links have been "
                     "found:\n" % len(cul_result))
             report_failed_links(cul_result, sys.stdout)
+            for failure in cul_result.values():
+                stream_failure(failure, "warning")
             soft_failure = True
     else:
-        # Can do a simple append here because these are all web failures
-        # and so don't need to check if the failure already exists in the
-        # list.
-        FAILED_LINKS += cul_result
+        record_failures(cul_result.values())
+    unchecked = unchecked_links()
+    if unchecked:
+        print("\n\nWARNING! %s web links could not be checked:\n" %
+              len(unchecked))
+        report_failed_links(unchecked, sys.stdout)
+        for failure in unchecked.values():
+            stream_failure(failure, "warning")
+        soft_failure = True
     return soft_failure
 
 
+def unchecked_links():
+    """ Return the (file, failure) pairs for the web links left unchecked. """
+    unchecked = {}
+    if UNCHECKED_LINKS:
+        for file, link in file_link_pairs():
+            if link in UNCHECKED_LINKS:
+                failure = failure_record(
+                    file, link, "external", error="unchecked")
+                unchecked[failure_key(failure)] = failure
+    return unchecked
+
+
 def github_create_issue(issue_url, assignees, token):
     """ Create a GitHub issue to report the failed links. """
     subject = ""
     fsock = io.StringIO()
-    if FAILED_DIRS != []:
-        subject = "%s directories with full-stops in name (invalid)" % len(FAILED_DIRS)
+    if SITE.failed_dirs:
+        subject = "%s directories with full-stops in name (invalid)" % len(SITE.failed_dirs)
         print("```", file=fsock)
-        report_failed_dirs(FAILED_DIRS, fsock)
+        report_failed_dirs(SITE.failed_dirs, fsock)
         print("```", file=fsock)
-    if FAILED_LINKS != []:
+    failed_count = failed_link_count()
+    if failed_count:
         if subject != "":
             subject += ", "
-        subject += "%s failed links" % len(FAILED_LINKS)
-        print("%s failed links have been found:" % len(FAILED_LINKS), file=fsock)
+        subject += "%s failed links" % failed_count
+        print("%s failed links have been found:" % failed_count, file=fsock)
         print("```", file=fsock)
-        report_failed_links(FAILED_LINKS, fsock)
+        # Leave room for the closing lines.
+        if not print_failed_links(
+                failed_links_by_file(), fsock, GITHUB_BODY_LIMIT - 200):
+            print("... (too many to list; see the link checker's output)",
+                  file=fsock)
         print("```", file=fsock)
 
     headers = {
@@ -612,14 +3352,15 @@ def output_failed_links():
         output_to = open(OUTPUT_FILE, 'w')
     else:
         print("")
-    if FAILED_DIRS != []:
+    if SITE.failed_dirs:
         print(
-            "%s directories found with full-stops in name (invalid):\n" % len(FAILED_DIRS),
+            "%s directories found with full-stops in name (invalid):\n" % len(SITE.failed_dirs),
             file=output_to)
-        report_failed_dirs(FAILED_DIRS, output_to)
-    if FAILED_LINKS != []:
-        print("%s failed links found:\n" % len(FAILED_LINKS), file=output_to)
-        report_failed_links(FAILED_LINKS, output_to)
+        report_failed_dirs(SITE.failed_dirs, output_to)
+    failed_count = failed_link_count()
+    if failed_count:
+        print("%s failed links found:\n" % failed_count, file=output_to)
+        print_failed_links(failed_links_by_file(), output_to)
     if OUTPUT_FILE is not None:
         output_to.close()
     # sys.exit(1)
@@ -634,18 +3375,36 @@ def report_failed_dirs(dir_list, output_to):
 def report_failed_links(link_list, output_to):
     """ Report all of the failed links for a given file. """
     failure_dict = failures_to_dict(link_list)
-    for file in sorted(failure_dict):
-        print("%s:" % file, file=output_to)
-        for ref in failure_dict[file]:
-            print("   %s" % ref, file=output_to)
+    print_failed_links(
+        ((file, failure_dict[file]) for file in sorted(failure_dict)),
+        output_to)
 
 
-if __name__ == '__main__':
+def print_failed_links(failures_by_file, output_to, limit=None):
+    """
+    Print each file followed by its failed links. If limit is given, stop
+    (returning False) rather than let the output grow beyond that size.
+    """
+    for file, refs in failures_by_file:
+        lines = ["%s:" % file] + ["   %s" % ref for ref in refs]
+        if limit is not None:
+            size = sum(len(line) + 1 for line in lines)
+            if output_to.tell() + size > limit:
+                return False
+        for line in lines:
+            print(line, file=output_to)
+    return True
+
+
+def build_arg_parser():
+    """ Return the parser for the command line arguments. """
     parser = argparse.ArgumentParser(description="Scan for broken links")
     parser.add_argument('-d', '--directory', nargs='?', default=None,
                         help='specifies the directory to scan')
-    # parser.add_argument('-r', '--redirects', nargs='?', default=None,
-    #                     help='specifies optional CSV file of URL redirects')
+    parser.add_argument('-r', '--redirects', nargs='?', default=None,
+                        help='specifies the JSON file of rules that the '
+                        'redirect Lambda uses; internal links that the rules '
+                        'redirect or rewrite to an existing page are valid')
     parser.add_argument('--skip-dns-check', nargs='?', default=None,
                         help='specifies text file of FQDNs to skip the DNS '
                         'check on')
@@ -663,6 +3422,11 @@ if __name__ == '__main__':
                         help='skips checking of external references')
     parser.add_argument('-o', '--output', nargs='?', default=None,
                         help='specifies output file for error results')
+    parser.add_argument('--format', choices=['jsonl', 'sarif', 'text'],
+                        default='text',
+                        help='specifies the format of the output file; with '
+                        'jsonl or sarif, each failure is written to it as soon '
+                        'as it is found (default: text)')
     parser.add_argument('--no-external-errors', action='store_true',
                         help='ignores errors caused by external broken links')
     parser.add_argument('--create-github-issue', action='store',
@@ -670,7 +3434,115 @@ if __name__ == '__main__':
     parser.add_argument('--assign-github-issue', action='store',
                         help='assigns the created issue to the array of names')
     parser.add_argument('--github-access-token', action='store')
-    args = parser.parse_args()
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='specifies the number of processes to check '
+                        'HTML files with; 0 uses all available CPUs')
+    parser.add_argument('--cache-file', nargs='?', default=None,
+                        help='specifies an SQLite file to cache external '
+                        'link results in between runs')
+    parser.add_argument('--cache-ttl', type=int, default=24*60*60,
+                        help='specifies how many seconds a cached successful '
+                        'result is used for (default: 1 day)')
+    parser.add_argument('--cache-failure-ttl', type=int, default=60*60,
+                        help='specifies how many seconds a cached failed '
+                        'result is used for (default: 1 hour)')
+    parser.add_argument('--cache-max-entries', type=int, default=100000,
+                        help='specifies the maximum number of links kept in '
+                        'the cache; the oldest are dropped first')
+    parser.add_argument('--canonical-query', action='store_true',
+                        help='treats web links whose query parameters only '
+                        'differ in order as the same link')
+    parser.add_argument('--max-connections', type=positive_int, default=500,
+                        help='specifies the maximum number of external links '
+                        'checked at once (default: 500)')
+    parser.add_argument('--per-host-limit', type=positive_int, default=10,
+                        help='specifies the maximum number of external links '
+                        'checked at once on any one host (default: 10)')
+    parser.add_argument('--per-host-delay', type=float, default=0.0,
+                        help='specifies the minimum number of seconds between '
+                        'starting requests to the same host (default: 0)')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='specifies how many times to retry an external '
+                        'link after a transient failure (default: 2)')
+    parser.add_argument('--retry-backoff', type=float, default=1.0,
+                        help='specifies the base number of seconds for the '
+                        'exponential backoff between retries (default: 1)')
+    parser.add_argument('--retry-max-delay', type=float, default=30.0,
+                        help='specifies the longest time to wait before a '
+                        'retry, including for Retry-After (default: 30)')
+    parser.add_argument('--circuit-breaker', type=int, default=5,
+                        help='specifies the number of consecutive transient '
+                        'failures, other than rate limiting, after which a '
+                        'host is no longer checked and its remaining links '
+                        'are reported as unchecked; 0 disables this '
+                        '(default: 5)')
+    parser.add_argument('--deadline', type=float, default=None,
+                        help='specifies how many seconds the run has to check '
+                        'the web links in; the most important are checked '
+                        'first and any left over are reported as unchecked')
+    parser.add_argument('--watch', action='store_true',
+                        help='after checking the directory, keeps watching it '
+                        'and checks it again each time it is rebuilt, printing '
+                        'the failures that have appeared or been fixed')
+    parser.add_argument('--manifest', nargs='?', default=None,
+                        help='specifies a manifest file to check incrementally '
+                        'against; only files that have changed since it was '
+                        'written are parsed, and only new web links checked')
+    parser.add_argument('--check-anchors', action='store_true',
+                        help='checks that fragments in internal links refer '
+                        'to an id on the target page')
+    parser.add_argument('--metrics-out', nargs='?', default=None,
+                        help='specifies a file to write timings and other '
+                        'metrics about the run to as JSON')
+    parser.add_argument('--unreferenced-top', type=int, default=UNREFERENCED_TOP,
+                        help='specifies how many of the directories, '
+                        'extensions and files using the most space to list '
+                        'after the unreferenced files (default: %s)' %
+                        UNREFERENCED_TOP)
+    parser.add_argument('--unreferenced-json', nargs='?', default=None,
+                        help='specifies a file to write the unreferenced files '
+                        'and their sizes, totalled by directory and extension, '
+                        'to as JSON')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='keeps the links found and the failures in an '
+                        'on-disk store rather than in memory, so that memory '
+                        'use stays flat for very large sites')
+    parser.add_argument('--spill-dir', nargs='?', default=None,
+                        help='specifies the directory for the --low-memory '
+                        'store (default: the system temporary directory)')
+    parser.add_argument('--shard', type=shard_spec, default=None,
+                        help='checks only part i of N of the site, given as '
+                        'i/N, and writes the results out for --merge')
+    parser.add_argument('--shard-out', nargs='?', default=None,
+                        help='specifies the file to write the results of '
+                        '--shard to (default: links-shard-i-of-N.json)')
+    parser.add_argument('--merge', nargs='+', default=None,
+                        help='combines the result files from all of the '
+                        'shards and reports on them')
+    parser.add_argument('--batch', nargs='+', default=None, metavar='DIRECTORY',
+                        help='checks several sites in one run, checking the '
+                        'web links they share only once, and reports on each '
+                        'site separately; the -o and --unreferenced-json files '
+                        'for each site have the name of its directory added')
+    parser.add_argument('--sitemap', nargs='?', default=None,
+                        help='checks the pages listed in a sitemap, given as '
+                        'a file or URL, by fetching them instead of reading '
+                        'a directory')
+    parser.add_argument('--url-list', nargs='?', default=None,
+                        help='checks the pages listed, one URL per line, in '
+                        'a file or at a URL, by fetching them')
+    parser.add_argument('--max-in-flight-bytes', type=int, default=64*1024**2,
+                        help='specifies roughly how many bytes of the pages '
+                        'being fetched can be held at once (default: 64MB)')
+    parser.add_argument('--parser', choices=sorted(EXTRACTORS),
+                        default='stream',
+                        help='specifies how links are extracted from HTML '
+                        'files (default: stream)')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
 
     print("Linaro Link Checker (2023-04-11)")
 
@@ -679,11 +3551,106 @@ if __name__ == '__main__':
     if args.skip_dns_check is not None:
         print("Loading FQDN skip list from %s" % args.skip_dns_check)
         try:
-            DNS_SKIP = list(open(args.skip_dns_check))
+            with open(args.skip_dns_check) as skip_file:
+                DNS_SKIP = {line.strip() for line in skip_file if line.strip()}
         except Exception as exception: # pylint: disable=broad-except
             print("Couldn't load FQDN skip list")
-    if args.output is not None:
+    if args.format != "text":
+        # The failures are streamed to the output file and the usual
+        # report goes to stdout.
+        if args.output is None:
+            print("--format %s needs an output file (-o)" % args.format)
+            sys.exit(1)
+        # The file is opened before the walk, so it mustn't end up in the
+        # directory being scanned.
+        args.output = os.path.abspath(args.output)
+    elif args.output is not None:
         OUTPUT_FILE = args.output
+    if args.jobs == 0:
+        JOBS = os.cpu_count() or 1
+    else:
+        JOBS = max(1, args.jobs)
+    COLLECT_ANCHORS = args.check_anchors
+    # The deadline is for the whole run, so the time spent checking the
+    # files counts against it too.
+    if args.deadline is not None:
+        DEADLINE = time.monotonic() + args.deadline
+    if args.low_memory:
+        # The manifest holds every file's tags and BeautifulSoup builds the
+        # whole document, both of which defeat the point.
+        if args.manifest is not None:
+            print("--low-memory can't be used with --manifest")
+            sys.exit(1)
+        if args.parser == "bs4":
+            print("--low-memory needs the stream or lxml parser")
+            sys.exit(1)
+        if args.spill_dir is not None:
+            args.spill_dir = os.path.abspath(args.spill_dir)
+    # These files are relative to where we were run from, not the directory
+    # being scanned.
+    if args.cache_file is not None:
+        args.cache_file = os.path.abspath(args.cache_file)
+    if args.redirects is not None:
+        args.redirects = os.path.abspath(args.redirects)
+        try:
+            REDIRECT_RULES, REDIRECT_RULES_HASH = load_redirect_rules(
+                args.redirects)
+        except (OSError, ValueError, re.error) as exception:
+            print("Couldn't load redirect rules from %s: %s" % (
+                args.redirects, exception))
+            sys.exit(1)
+        print("Loaded %s redirect rules" % len(REDIRECT_RULES))
+    if args.manifest is not None:
+        args.manifest = os.path.abspath(args.manifest)
+        MANIFEST = load_manifest(args.manifest)
+    if args.metrics_out is not None:
+        args.metrics_out = os.path.abspath(args.metrics_out)
+    if args.unreferenced_json is not None:
+        args.unreferenced_json = os.path.abspath(args.unreferenced_json)
+    UNREFERENCED_TOP = max(0, args.unreferenced_top)
+    if args.sitemap is not None and args.url_list is not None:
+        print("Only one of --sitemap and --url-list can be given")
+        sys.exit(1)
+    for option in ("sitemap", "url_list"):
+        value = getattr(args, option)
+        if value is not None and as_web_link(value) is None:
+            setattr(args, option, os.path.abspath(value))
+    if scanning_urls() and (args.manifest is not None or args.shard is not None):
+        print("--manifest and --shard need a directory to check")
+        sys.exit(1)
+    if args.shard is not None:
+        if args.manifest is not None or args.low_memory:
+            print("--shard can't be used with --manifest or --low-memory")
+            sys.exit(1)
+        # Each shard only has part of the results, so they are reported on
+        # by --merge.
+        if args.output is not None or args.create_github_issue is not None:
+            print("--shard can't be used with -o, --format or "
+                  "--create-github-issue; give them to --merge instead")
+            sys.exit(1)
+        if args.shard_out is None:
+            args.shard_out = "links-shard-%s-of-%s.json" % args.shard
+        args.shard_out = os.path.abspath(args.shard_out)
+    if args.merge is not None:
+        args.merge = [os.path.abspath(shard_file) for shard_file in args.merge]
+    if args.batch is not None:
+        if (args.directory is not None or scanning_urls() or
+                args.manifest is not None or args.shard is not None or
+                args.merge is not None or args.low_memory):
+            print("--batch can't be used with -d, --sitemap, --url-list, "
+                  "--manifest, --shard, --merge or --low-memory")
+            sys.exit(1)
+        if args.create_github_issue is not None:
+            print("--batch reports on each site separately so can't create "
+                  "a GitHub issue")
+            sys.exit(1)
+        args.batch = [os.path.abspath(directory) for directory in args.batch]
+    if args.watch and (scanning_urls() or args.shard is not None or
+                       args.merge is not None or args.batch is not None or
+                       args.low_memory):
+        print("--watch needs a single directory and can't be used with "
+              "--shard, --merge, --batch or --low-memory")
+        sys.exit(1)
     if args.directory is not None:
         print("Scanning '%s'" % args.directory)
         os.chdir(args.directory)
@@ -691,26 +3658,36 @@ if __name__ == '__main__':
         print("Skipping internal link checking")
     if args.noexternal:
         print("Skipping external link checking")
-    # For now, assume that we're just scanning the current directory. Add code
-    # for file paths and possibly URLs at a future date ...
-    scan_directory(
-        "./",
-        args.skip_path,
-        args.create_github_issue,
-        args.assign_github_issue,
-        args.github_access_token)
-
-    # Before we produce a list of unreferenced files, mark the obvious files
-    # as referenced ... this is a bit hacky there 
-    for file in PROTECTED_FILES:
-        reference_file(file)
-
-    if len(ALL_FILES) == 0:
-        print("All files are referenced.")
+    if args.merge is not None:
+        with failure_stream():
+            merge_shards(
+                args.merge,
+                args.create_github_issue,
+                args.assign_github_issue,
+                args.github_access_token)
+    elif args.batch is not None:
+        scan_batch(args.batch, args.skip_path)
     else:
-        print("The following files do not appear to be referenced:")
-        size = 0
-        for unref in ALL_FILES:
-            print(unref)
-            size += os.path.getsize(unref)
-        print(f"Possible size to reclaim: {size/1024**2}MB")
+        # For now, assume that we're just scanning the current directory.
+        # Add code for file paths and possibly URLs at a future date ...
+        scan_directory(
+            "./",
+            args.skip_path,
+            args.create_github_issue,
+            args.assign_github_issue,
+            args.github_access_token)
+    if args.shard is not None:
+        if args.metrics_out is not None:
+            write_metrics(args.metrics_out)
+        sys.exit(0)
+
+    # There are no files to report on when the pages have been fetched, and
+    # --batch has already reported on each site.
+    if not scanning_urls() and args.batch is None:
+        report_unreferenced()
+
+    if args.metrics_out is not None:
+        write_metrics(args.metrics_out)
+
+    if args.watch:
+        watch_directory("./", args.skip_path)